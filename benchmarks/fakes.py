@@ -0,0 +1,548 @@
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+# Library id of the synthetic Zotero library
+LIBRARY_ID = '1'
+
+def content(key, revision, size):
+    """
+
+    Content of the file of a synthetic attachment. It is
+    pseudo-random so it does not compress when zipped.
+
+    Args:
+        key: attachment key
+        revision: revision of the file, changed by modify()
+        size: size of the file in bytes
+
+    Returns: bytes of the file
+
+    """
+
+    header = b'%PDF-1.4\n'
+    body = random.Random(f'{key}:{revision}').randbytes(max(size - len(header), 0))
+
+    return (header + body)[:size]
+
+
+def date(version):
+    """
+
+    Date of a synthetic item, one second per library version
+
+    Args:
+        version: library version of the change
+
+    Returns: date in the format of the Zotero API
+
+    """
+
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(1600000000 + version))
+
+
+def matches(expression, values):
+    """
+
+    Evaluate a filter of the Zotero API
+
+    Args:
+        expression: 'a', 'a || b' or '-a', None for no filter
+        values: tags or item type of an item
+
+    Returns: True if the item matches
+
+    """
+
+    if expression is None:
+        return True
+
+    if expression.startswith('-'):
+        return expression[1:] not in values
+
+    return any(i in values for i in expression.split(' || '))
+
+
+class FakeService():
+
+    def __init__(self, latency = 0):
+        """
+
+        In-process HTTP stand-in for a web API, counting
+        the requests and the bytes sent and received
+
+        Args:
+            latency: seconds added to every request
+
+        """
+
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.server = None
+        self.reset()
+
+    def reset(self):
+        """
+
+        Reset the counters
+
+        """
+
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def counters(self):
+        """
+
+        Returns: dict with the requests and the bytes
+                 received (bytes_in) and sent (bytes_out)
+
+        """
+
+        return {'requests': self.requests,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out}
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """
+
+        Serve the API on a free port of localhost
+
+        Returns: base url of the API
+
+        """
+
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def dispatch(self):
+                service.dispatch(self)
+
+            do_GET = do_PUT = do_POST = do_DELETE = dispatch
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        return self.url
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def dispatch(self, request):
+        """
+
+        Answer a request with the response of handle()
+
+        Args:
+            request: BaseHTTPRequestHandler of the request
+
+        """
+
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlsplit(request.path)
+        query = {k: v if k == 'tag' else v[-1] for k, v in parse_qs(url.query).items()}
+
+        status, headers, data = self.handle(request.command, url.path,
+                                            query, request.headers, body)
+
+        if not isinstance(data, bytes):
+            data = json.dumps(data).encode()
+            headers.setdefault('Content-Type', 'application/json')
+
+        with self.lock:
+            self.requests += 1
+            self.bytes_in += len(body)
+            self.bytes_out += len(data)
+
+        request.send_response(status)
+        for k, v in headers.items():
+            request.send_header(k, str(v))
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def handle(self, method, path, query, headers, body):
+        """
+
+        Args:
+            method: HTTP method
+            path: path of the url
+            query: dict with the query parameters
+            headers: request headers
+            body: request body
+
+        Returns: (status, dict of headers, body), a body
+                 that is not bytes is sent as JSON
+
+        """
+
+        return 404, {}, {'error': 'not found'}
+
+
+class FakeZotero(FakeService):
+
+    def __init__(self, collections = 20, depth = 3, pdfs = 200,
+                 size = 256 * 1024, seed = 0, latency = 0):
+        """
+
+        Stand-in for the Zotero web API serving a synthetic
+        user library. Half of the .pdf attachments are
+        children of a regular item, the other half are
+        standalone items.
+
+        Args:
+            collections: number of collections
+            depth: number of levels of the collection tree
+            pdfs: number of .pdf attachments
+            size: size of the files in bytes
+            seed: seed of the generated library
+            latency: seconds added to every request
+
+        """
+
+        super().__init__(latency)
+
+        self.rng = random.Random(seed)
+        self.size = size
+        self.version = 1
+        self.collections = {}
+        self.items = {}
+        self.revisions = {}
+        self.deleted = {'items': {}, 'collections': {}}
+        self.count = 0
+
+        levels = [[] for _ in range(max(depth, 1))]
+
+        for i in range(collections):
+            level = i * len(levels) // max(collections, 1)
+            parent = self.rng.choice(levels[level - 1]) if level > 0 and levels[level - 1] else False
+            key = self.new_key()
+
+            self.collections[key] = {'key': key, 'version': self.version,
+                                     'name': f'collection-{i:04}', 'parent': parent}
+            levels[level].append(key)
+
+        for i in range(pdfs):
+            self.add(self.rng.choice(list(self.collections)))
+
+    def new_key(self):
+        return ''.join(self.rng.choice('23456789ABCDEFGHIJKLMNPQRSTUVWXYZ')
+                       for _ in range(8))
+
+    def bump(self):
+        self.version += 1
+        return self.version
+
+    def add(self, collection):
+        """
+
+        Add a .pdf attachment to a collection, every
+        other one as the child of a new regular item
+
+        Args:
+            collection: collection key
+
+        Returns: attachment key
+
+        """
+
+        version = self.bump()
+        key = self.new_key()
+        data = {'itemType': 'attachment', 'title': f'paper-{self.count:06}.pdf',
+                'contentType': 'application/pdf', 'linkMode': 'imported_file',
+                'dateAdded': date(version), 'dateModified': date(version)}
+
+        if self.count % 2:
+            parent = self.new_key()
+            self.items[parent] = {'key': parent, 'version': version,
+                                  'data': {'itemType': 'journalArticle',
+                                           'title': f'Paper {self.count}',
+                                           'collections': [collection]}}
+            data['parentItem'] = parent
+        else:
+            data['collections'] = [collection]
+
+        self.items[key] = {'key': key, 'version': version, 'data': data}
+        self.revisions[key] = 0
+        self.store_file(key)
+        self.count += 1
+
+        return key
+
+    def store_file(self, key):
+        data = self.items[key]['data']
+        data['md5'] = hashlib.md5(content(key, self.revisions[key], self.size)).hexdigest()
+        data['mtime'] = int(time.time() * 1000) + self.revisions[key]
+
+    def attachments(self):
+        """
+
+        Returns: keys of the .pdf attachments
+
+        """
+
+        return [k for k, i in self.items.items()
+                if i['data']['itemType'] == 'attachment' and not i['data'].get('deleted')]
+
+    def modify(self, key):
+        """
+
+        Replace the file of an attachment
+
+        Args:
+            key: attachment key
+
+        """
+
+        self.revisions[key] += 1
+        self.store_file(key)
+        self.items[key]['version'] = self.bump()
+        self.items[key]['data']['dateModified'] = date(self.version)
+
+    def move(self, key, collection):
+        """
+
+        Move an attachment, or its parent item,
+        to another collection
+
+        Args:
+            key: attachment key
+            collection: collection key
+
+        """
+
+        item = self.items[self.items[key]['data'].get('parentItem') or key]
+        item['data']['collections'] = [collection]
+        item['version'] = self.bump()
+
+    def delete(self, keys):
+        """
+
+        Delete items and their children
+
+        Args:
+            keys: list of item keys
+
+        """
+
+        version = self.bump()
+        keys = set(keys)
+        keys |= {k for k, i in self.items.items() if i['data'].get('parentItem') in keys}
+
+        for key in keys:
+            if self.items.pop(key, None):
+                self.deleted['items'][key] = version
+
+    def members(self):
+        """
+
+        Returns: dict collection key -> items of the collection,
+                 child items are in the collections of their parent
+
+        """
+
+        members = {}
+
+        for i in self.items.values():
+            parent = self.items.get(i['data'].get('parentItem'), i)
+
+            for c in parent['data'].get('collections', []):
+                members.setdefault(c, []).append(i)
+
+        return members
+
+    def item_json(self, item):
+        return {'key': item['key'], 'version': item['version'],
+                'library': {'type': 'user', 'id': int(LIBRARY_ID)},
+                'data': {'key': item['key'], 'version': item['version'], **item['data']}}
+
+    def collection_json(self, c, members):
+        return {'key': c['key'], 'version': c['version'],
+                'meta': {'numCollections': 0, 'numItems': len(members.get(c['key'], []))},
+                'data': {'key': c['key'], 'version': c['version'], 'name': c['name'],
+                         'parentCollection': c['parent']}}
+
+    def page(self, path, query, results):
+        """
+
+        Paginate a multi-object response like the API,
+        with a Link header to the next page
+
+        """
+
+        start = int(query.get('start', 0))
+        limit = int(query.get('limit', 100)) if query.get('limit') else len(results)
+
+        headers = {'Last-Modified-Version': self.version,
+                   'Total-Results': len(results)}
+
+        if start + limit < len(results):
+            following = urlencode({**query, 'start': start + limit}, doseq=True)
+            headers['Link'] = f'<{self.url}{path}?{following}>; rel="next"'
+
+        return 200, headers, results[start:start + limit]
+
+    def select(self, items, query):
+        since = int(query.get('since', 0))
+        keys = set(query['itemKey'].split(',')) if query.get('itemKey') else None
+        text = query.get('q', '').lower()
+
+        return [self.item_json(i) for i in items
+                if i['version'] > since and
+                (keys is None or i['key'] in keys) and
+                matches(query.get('itemType'), [i['data']['itemType']]) and
+                all(matches(t, [j['tag'] for j in i['data'].get('tags', [])])
+                    for t in query.get('tag', [])) and
+                text in i['data'].get('title', '').lower() and
+                (query.get('includeTrashed') == '1' or not i['data'].get('deleted'))]
+
+    def handle(self, method, path, query, headers, body):
+        prefix = f'/users/{LIBRARY_ID}'
+
+        if not path.startswith(prefix):
+            return super().handle(method, path, query, headers, body)
+
+        parts = path[len(prefix):].strip('/').split('/')
+
+        with self.lock:
+            if method == 'DELETE' and parts == ['items']:
+                if int(headers.get('If-Unmodified-Since-Version', -1)) != self.version:
+                    return 412, {'Last-Modified-Version': self.version}, b''
+
+                self.delete(query.get('itemKey', '').split(','))
+                return 204, {'Last-Modified-Version': self.version}, b''
+
+            if method != 'GET':
+                return super().handle(method, path, query, headers, body)
+
+            if parts == ['items'] or parts == ['items', 'top']:
+                items = [i for i in self.items.values()
+                         if parts == ['items'] or not i['data'].get('parentItem')]
+                return self.page(path, query, self.select(items, query))
+
+            if len(parts) == 3 and parts[0] == 'items' and parts[2] == 'file':
+                if parts[1] not in self.items:
+                    return 404, {}, b''
+
+                revision = self.revisions[parts[1]]
+
+            elif parts == ['collections']:
+                since = int(query.get('since', 0))
+                members = self.members()
+                return self.page(path, query, [self.collection_json(c, members)
+                                               for c in self.collections.values()
+                                               if c['version'] > since])
+
+            elif len(parts) == 2 and parts[0] == 'collections':
+                return 200, {'Last-Modified-Version': self.version}, \
+                    self.collection_json(self.collections[parts[1]], self.members())
+
+            elif len(parts) == 3 and parts[0] == 'collections' and parts[2] == 'items':
+                return self.page(path, query,
+                                 self.select(self.members().get(parts[1], []), query))
+
+            elif parts == ['deleted']:
+                since = int(query.get('since', 0))
+                return 200, {'Last-Modified-Version': self.version}, \
+                    {k: [key for key, v in self.deleted.get(k, {}).items() if v > since]
+                     for k in ('collections', 'searches', 'items', 'tags', 'settings')}
+
+            else:
+                return super().handle(method, path, query, headers, body)
+
+        # Files are generated outside of the lock
+        return 200, {'Content-Type': 'application/pdf'}, \
+            content(parts[1], revision, self.size)
+
+
+class FakeReMarkable(FakeService):
+
+    def __init__(self, latency = 0):
+        """
+
+        Stand-in for the reMarkable cloud API (document
+        storage and user token). Uploaded files are
+        counted but not kept.
+
+        Args:
+            latency: seconds added to every request
+
+        """
+
+        super().__init__(latency)
+
+        self.items = {}
+        self.blobs = {}
+
+    def handle(self, method, path, query, headers, body):
+        with self.lock:
+            if path == '/token/json/2/user/new':
+                return 200, {'Content-Type': 'text/plain'}, b'user-token'
+
+            if method == 'GET' and path == '/document-storage/json/2/docs':
+                if 'doc' in query:
+                    item = self.items.get(query['doc'])
+                    return 200, {}, [item] if item else []
+
+                return 200, {}, list(self.items.values())
+
+            if method == 'PUT' and path.startswith('/blob/'):
+                self.blobs[path[len('/blob/'):]] = len(body)
+                return 200, {}, b''
+
+            if method != 'PUT':
+                return super().handle(method, path, query, headers, body)
+
+            requests = json.loads(body or b'[]')
+
+            if path == '/document-storage/json/2/upload/request':
+                return 200, {}, [{'ID': i['ID'], 'Version': i['Version'],
+                                  'Message': '', 'Success': True,
+                                  'BlobURLPut': f"{self.url}/blob/{i['ID']}",
+                                  'BlobURLPutExpires': ''} for i in requests]
+
+            if path == '/document-storage/json/2/upload/update-status':
+                for i in requests:
+                    self.items[i['ID']] = {**i, 'Success': True, 'Message': ''}
+
+                return 200, {}, [{'ID': i['ID'], 'Version': i['Version'],
+                                  'Message': '', 'Success': True} for i in requests]
+
+            if path == '/document-storage/json/2/delete':
+                results = []
+
+                for i in requests:
+                    found = self.items.pop(i['ID'], None) is not None
+                    self.blobs.pop(i['ID'], None)
+                    results.append({'ID': i['ID'], 'Version': i['Version'],
+                                    'Message': '' if found else 'not found',
+                                    'Success': found})
+
+                return 200, {}, results
+
+        return super().handle(method, path, query, headers, body)
@@ -0,0 +1,353 @@
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync
+from utils.zotero import Zotero
+from utils.remarkable import ReMarkable
+from utils import scheduler
+from benchmarks.fakes import FakeZotero, FakeReMarkable, LIBRARY_ID
+
+SCENARIOS = ('initial', 'noop', 'churn', 'delete')
+
+# Metrics compared with a baseline
+METRICS = ('wall_time', 'requests', 'bytes', 'peak_rss')
+
+# reMarkable user token that does not expire
+TOKEN = 'e30.' + base64.urlsafe_b64encode(b'{"exp": 4102444800}').decode().rstrip('=') + '.e30'
+
+def get_args():
+    """Command line argument parsing"""
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sync against in-process fake ' +
+                    'Zotero and reMarkable services.')
+
+    parser.add_argument('scenarios',
+                        nargs='*',
+                        metavar='scenario',
+                        help='Scenarios to run (default all): initial sync, ' +
+                             'sync without changes (noop), sync after 1%% of the ' +
+                             'files changed (churn) and after a bulk delete (delete).')
+
+    parser.add_argument('--collections', type=int, default=20,
+                        help='Number of collections of the library.')
+
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Number of levels of the collection tree.')
+
+    parser.add_argument('--pdfs', type=int, default=200,
+                        help='Number of .pdf attachments of the library.')
+
+    parser.add_argument('--size', type=int, default=256 * 1024,
+                        help='Size of the files in bytes.')
+
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Milliseconds added to every request.')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the generated library and changes.')
+
+    parser.add_argument('--zot-fetch-mode', type=str, default='library',
+                        choices=['library', 'collections'])
+
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of concurrent downloads and uploads.')
+
+    parser.add_argument('--zot-rate', type=float, default=scheduler.RATE,
+                        help='Requests per second to Zotero, 0 for no limit.')
+
+    parser.add_argument('--rm-rate', type=float, default=scheduler.RATE,
+                        help='Requests per second to reMarkable, 0 for no limit.')
+
+    parser.add_argument('--mirrorless', default=False, action='store_true')
+
+    parser.add_argument('--json', default=False, action='store_true',
+                        help='Print the results as JSON.')
+
+    parser.add_argument('--save', type=str,
+                        help='Save the results to a JSON file.')
+
+    parser.add_argument('--baseline', type=str,
+                        help='JSON file with the results to compare with, ' +
+                             'exit with status 1 on a regression.')
+
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed increase over the baseline (default 0.25).')
+
+    args = parser.parse_args()
+
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}, " +
+                         f"choose from {', '.join(SCENARIOS)}")
+
+    return args
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process, on Linux"""
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+
+    Returns: peak resident set size of the process in bytes,
+             since the last reset on Linux
+
+    """
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+
+    except OSError:
+        pass
+
+    import resource
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def connect(zot_api, rm_api, dir, options):
+    """
+
+    Zotero and ReMarkable instances using the fake services,
+    new ones for every run like a new run of sync.py
+
+    Args:
+        zot_api: FakeZotero service
+        rm_api: FakeReMarkable service
+        dir: local directory
+        options: dict with the command line options
+
+    Returns: (Zotero, ReMarkable)
+
+    """
+
+    import rmapy.api
+
+    rmapy.api.BASE_URL = rm_api.url
+    rmapy.api.USER_TOKEN_URL = f'{rm_api.url}/token/json/2/user/new'
+    rmapy.api.load = lambda: {'devicetoken': 'device-token', 'usertoken': TOKEN}
+    rmapy.api.dump = lambda config: None
+
+    scheduler.configure('zotero', rate=options['zot_rate'], concurrency=options['workers'])
+    scheduler.configure('remarkable', rate=options['rm_rate'], concurrency=options['workers'])
+
+    zot = Zotero(dir, LIBRARY_ID, 'api-key',
+                 fetch_mode=options['zot_fetch_mode'],
+                 workers=options['workers'])
+    zot.zot.endpoint = zot_api.url
+
+    rm = ReMarkable(dir, 'Zotero', workers=options['workers'])
+
+    return zot, rm
+
+
+def change(zot_api, scenario, rng):
+    """
+
+    Change the library of the fake Zotero service
+
+    Args:
+        zot_api: FakeZotero service
+        scenario: 'churn' modifies, moves and adds 1% of
+                  the files, 'delete' deletes a quarter of them
+        rng: random.Random instance
+
+    """
+
+    keys = sorted(zot_api.attachments())
+
+    if scenario == 'churn':
+        collections = sorted(zot_api.collections)
+
+        for i, key in enumerate(rng.sample(keys, max(1, len(keys) // 100))):
+            if i % 3 == 0:
+                zot_api.modify(key)
+            elif i % 3 == 1:
+                zot_api.move(key, rng.choice(collections))
+            else:
+                zot_api.add(rng.choice(collections))
+
+    elif scenario == 'delete':
+        zot_api.delete([zot_api.items[k]['data'].get('parentItem') or k
+                        for k in rng.sample(keys, len(keys) // 4)])
+
+
+def run(scenario, options):
+    """
+
+    Run a scenario, in a process of its own
+
+    Args:
+        scenario: 'initial', 'noop', 'churn' or 'delete'
+        options: dict with the command line options
+
+    Returns: dict with the results
+
+    """
+
+    work = tempfile.mkdtemp(prefix='zot_rm_bench_')
+    dir = os.path.join(work, 'Zotero')
+    mirror = not options['mirrorless']
+    rng = random.Random(options['seed'])
+
+    zot_api = FakeZotero(options['collections'], options['depth'], options['pdfs'],
+                         options['size'], options['seed'])
+    rm_api = FakeReMarkable()
+
+    zot_api.start()
+    rm_api.start()
+
+    try:
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            manifest = sync.open_manifest(dir)
+
+            # The library is synced once before the changes
+            if scenario != 'initial':
+                zot, rm = connect(zot_api, rm_api, dir, options)
+
+                if not sync.initialize(zot, rm, dir, manifest, mirror):
+                    raise Exception('initial sync failed')
+
+                change(zot_api, scenario, rng)
+
+            zot, rm = connect(zot_api, rm_api, dir, options)
+
+            for api in (zot_api, rm_api):
+                api.latency = options['latency'] / 1000
+                api.reset()
+
+            reset_peak_rss()
+            start = time.perf_counter()
+
+            if scenario == 'initial':
+                success = sync.initialize(zot, rm, dir, manifest, mirror)
+            else:
+                success = sync.sync(zot, rm, dir, manifest, True, mirror)
+
+            wall_time = time.perf_counter() - start
+
+        zotero = zot_api.counters()
+        remarkable = rm_api.counters()
+
+        return {'scenario': scenario,
+                'success': bool(success),
+                'wall_time': wall_time,
+                'requests': zotero['requests'] + remarkable['requests'],
+                'bytes': sum(zotero[k] + remarkable[k] for k in ('bytes_in', 'bytes_out')),
+                'peak_rss': peak_rss(),
+                'zotero': zotero,
+                'remarkable': remarkable}
+
+    finally:
+        zot_api.stop()
+        rm_api.stop()
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def regressions(results, baseline, tolerance):
+    """
+
+    Compare the results with a baseline
+
+    Args:
+        results: list of results
+        baseline: list of results to compare with
+        tolerance: allowed relative increase
+
+    Returns: list of messages, one for every regression
+
+    """
+
+    baseline = {i['scenario']: i for i in baseline}
+    messages = []
+
+    for result in results:
+        base = baseline.get(result['scenario'])
+
+        if base is None:
+            continue
+
+        if not result['success']:
+            messages.append(f"{result['scenario']}: sync failed")
+
+        for metric in METRICS:
+            if result[metric] > base[metric] * (1 + tolerance):
+                messages.append(f"{result['scenario']}: {metric} {result[metric]:.6g} " +
+                                f"> {base[metric]:.6g} (+{tolerance:.0%})")
+
+    return messages
+
+
+def report(results):
+    """Print the results as a table"""
+
+    print(f"{'scenario':<10}{'ok':>4}{'time (s)':>11}{'requests':>10}" +
+          f"{'MiB':>10}{'peak MiB':>10}")
+
+    for i in results:
+        print(f"{i['scenario']:<10}{'yes' if i['success'] else 'no':>4}" +
+              f"{i['wall_time']:>11.3f}{i['requests']:>10}" +
+              f"{i['bytes'] / 2**20:>10.2f}{i['peak_rss'] / 2**20:>10.1f}")
+
+
+def main():
+    args = get_args()
+    options = vars(args)
+    results = []
+
+    # A new process for every scenario, so the peak
+    # memory is not the one of the previous scenarios
+    context = multiprocessing.get_context('spawn')
+
+    for scenario in dict.fromkeys(args.scenarios or SCENARIOS):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.append(pool.submit(run, scenario, options).result())
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            messages = regressions(results, json.load(f), args.tolerance)
+
+        for message in messages:
+            print(f"REGRESSION - {message}")
+
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
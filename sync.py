@@ -1,11 +1,23 @@
 import os
 import sys
+import time
 import argparse
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from colorama import Fore, Style
-from utils.common import list_local_files, compare
+from utils.common import scan_local_files, file_md5, diff, load_json, priority
+from utils.manifest import Manifest
 from utils.zotero import Zotero
+from utils.zotero_local import ZoteroLocal
 from utils.remarkable import ReMarkable
+from utils.report import report, Profiler
+from utils.scope import Scope
+from utils.budget import Budget
+from utils import scheduler
+
+# Options of the whole run, the requests of every
+# target go through one scheduler per backend
+RUN_OPTIONS = ('zot_rate', 'rm_rate', 'max_duration', 'max_bytes')
 
 def get_args():
     """Command line argument parsing"""
@@ -14,27 +26,208 @@ def get_args():
 
     parser.add_argument('--zot-library-id', '-l',
                         type=str,
-                        required=True,
-                        help='Zotero personal library id.')
+                        required=False,
+                        help='Zotero personal or group library id.')
+
+    parser.add_argument('--zot-library-type',
+                        type=str,
+                        default='user',
+                        choices=['user', 'group'],
+                        help='Type of the Zotero library.')
 
     parser.add_argument('--zot-api-key', '-k',
                         type=str,
-                        required=True,
+                        required=False,
                         help='Zotero API Key.')
 
+    parser.add_argument('--zot-backend',
+                        type=str,
+                        default='web',
+                        choices=['web', 'local'],
+                        help='Read the Zotero library from the web API (web) ' +
+                             'or from the database of Zotero desktop (local).')
+
+    parser.add_argument('--zot-data-dir',
+                        type=str,
+                        default='~/Zotero',
+                        help='Zotero desktop data directory, ' +
+                             'with zotero.sqlite and storage/ (local backend).')
+
     parser.add_argument('--directory', '-d',
                         type=str,
-                        required=True,
+                        required=False,
                         help='Folder in reMarkable root that will sync')
 
+    parser.add_argument('--config',
+                        type=str,
+                        help='JSON file with several libraries and directories ' +
+                             'to sync, instead of --directory. See README.md.')
+
+    parser.add_argument('--zot-fetch-mode',
+                        type=str,
+                        default='library',
+                        choices=['library', 'collections'],
+                        help='List all the Zotero attachments at once (library) ' +
+                             'or the items of each collection (collections).')
+
+    for rule, help in (('collection', 'collection path, like Papers/ML, and its subcollections'),
+                       ('tag', 'tag of the items'),
+                       ('item-type', 'Zotero item type of the items, like journalArticle')):
+        parser.add_argument(f'--include-{rule}',
+                            action='append',
+                            default=[],
+                            help=f'Sync only the files of this {help}. Can be repeated.')
+
+        parser.add_argument(f'--exclude-{rule}',
+                            action='append',
+                            default=[],
+                            help=f'Do not sync the files of this {help}. Can be repeated.')
+
+    parser.add_argument('--zot-workers',
+                        type=int,
+                        default=4,
+                        help='Number of concurrent downloads from Zotero.')
+
+    parser.add_argument('--rm-workers',
+                        type=int,
+                        default=4,
+                        help='Number of concurrent uploads to reMarkable.')
+
+    parser.add_argument('--zot-rate',
+                        type=float,
+                        default=scheduler.RATE,
+                        help='Requests per second to the Zotero API, 0 for no limit.')
+
+    parser.add_argument('--rm-rate',
+                        type=float,
+                        default=scheduler.RATE,
+                        help='Requests per second to the reMarkable cloud, 0 for no limit.')
+
+    parser.add_argument('--mirrorless',
+                        default=False,
+                        action='store_true',
+                        help='Do not keep a local copy of the files, ' +
+                             'stream them from Zotero to reMarkable.')
+
+    parser.add_argument('--max-duration',
+                        type=float,
+                        help='Seconds the run can last. No transfer is started ' +
+                             'after them, the files left are synced by the next run.')
+
+    parser.add_argument('--max-bytes',
+                        type=int,
+                        help='Bytes the run can download from Zotero and upload ' +
+                             'to reMarkable. No transfer is started after them, ' +
+                             'the files left are synced by the next run.')
+
+    parser.add_argument('--watch',
+                        default=False,
+                        action='store_true',
+                        help='Keep running and sync every time Zotero ' +
+                             'or reMarkable change.')
+
+    parser.add_argument('--watch-interval',
+                        type=float,
+                        default=30,
+                        help='Seconds between checks for changes while watching.')
+
+    parser.add_argument('--watch-max-interval',
+                        type=float,
+                        default=900,
+                        help='Longest wait between checks, reached doubling ' +
+                             'the interval while nothing changes.')
+
+    parser.add_argument('--report',
+                        type=str,
+                        choices=['json'],
+                        help='Print at the end of the run the time of every ' +
+                             'phase, the requests and bytes of every backend ' +
+                             'and the duration of every file transfer.')
+
+    parser.add_argument('--report-file',
+                        type=str,
+                        help='Write the report to a file instead of stdout.')
+
+    parser.add_argument('--profile',
+                        type=str,
+                        nargs='?',
+                        const='sync.prof',
+                        help='Profile the run with cProfile and dump ' +
+                             'the stats to a file (default sync.prof).')
+
     parser.add_argument('--initialize', '-ini', default=False, action='store_true', required=False)
 
+    parser.add_argument('--adopt',
+                        default=False,
+                        action='store_true',
+                        help='With --initialize, keep the files already in the ' +
+                             'local directory and in reMarkable, matching them ' +
+                             'to the Zotero files, and transfer only the missing ones.')
+
     parser.add_argument('--quiet', '-q', default=False, action='store_true', required=False)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if args.adopt and not args.initialize:
+        parser.error('--adopt requires --initialize')
+
+    if (args.max_duration is not None and args.max_duration <= 0) or \
+            (args.max_bytes is not None and args.max_bytes <= 0):
+        parser.error('--max-duration and --max-bytes must be positive')
+
+    # An initialization records every file as synced
+    if args.initialize and (args.max_duration is not None or args.max_bytes is not None):
+        parser.error('--max-duration and --max-bytes bound a sync, not --initialize')
+
+    if (args.config is None) == (args.directory is None):
+        parser.error('either --directory or --config is required')
+
+    # Options of every target, the ones of the config
+    # file override the ones of the command line
+    args.concurrency = 1
+    args.targets = [vars(args)]
+
+    if args.config is not None:
+        config = load_json(args.config)
+
+        if not isinstance(config, dict) or not config.get('targets'):
+            parser.error(f'{args.config} has no targets')
+
+        if args.watch:
+            parser.error('--watch syncs a single --directory')
+
+        defaults = {k: v for k, v in config.items() if k not in ('targets', 'concurrency')}
 
+        for target in config['targets']:
+            for key in RUN_OPTIONS:
+                if key in target:
+                    parser.error(f'{key} applies to every target, ' +
+                                 f'set it at the top of {args.config}')
 
-def initialize(zot, rm, dir):
+        for key in RUN_OPTIONS + ('zot_workers', 'rm_workers'):
+            setattr(args, key, defaults.get(key, getattr(args, key)))
+
+        args.concurrency = config.get('concurrency', 2)
+        args.targets = [{**vars(args), **defaults, **target} for target in config['targets']]
+
+    directories = [i['directory'] for i in args.targets]
+
+    for options in args.targets:
+        if options['directory'] is None:
+            parser.error('every target needs a directory')
+
+        if directories.count(options['directory']) > 1:
+            parser.error(f"directory {options['directory']} is synced more than once")
+
+        if ((options['zot_backend'] == 'web') &
+            ((options['zot_library_id'] is None) | (options['zot_api_key'] is None))):
+            parser.error('--zot-library-id and --zot-api-key are required ' +
+                         f"by the web backend ({options['directory']})")
+
+    return args
+
+
+def initialize(zot, rm, dir, manifest, mirror = True):
     """
     Initialize the local directory
 
@@ -42,6 +235,8 @@ def initialize(zot, rm, dir):
         zot: Zotero instance
         rm: ReMarkable instance
         dir: local directory
+        manifest: Manifest of the synced files
+        mirror: keep a local copy of the files
     """
 
     if not os.path.exists(dir):
@@ -49,33 +244,32 @@ def initialize(zot, rm, dir):
     else:
         shutil.rmtree(dir)
 
-    if not zot.fetch():
-        return False
-
-    if not rm.fetch():
+    if not fetch(zot, rm):
         return False
 
     zot_paths = [i.path for i in zot.files]
     rm_paths = [i.path for i in rm.files]
 
-    print(Fore.GREEN +
-          "Initializing local directory..." +
-          Style.RESET_ALL)
-
-    if not zot.pull(zot_paths, []):
-        return False
-
-    for file in zot_paths:
+    if mirror:
         print(Fore.GREEN +
-              f"\t Downloaded to local dir: {file}" +
+              "Initializing local directory..." +
               Style.RESET_ALL)
 
+        if not report.timed('zotero.pull', zot.pull, [('add', i) for i in zot_paths], []):
+            return False
+
+        for file in zot_paths:
+            print(Fore.GREEN +
+                  f"\t Downloaded to local dir: {file}" +
+                  Style.RESET_ALL)
+
     if len(rm_paths) == 0:
         print(Fore.GREEN +
               "Initializing reMarkable..." +
               Style.RESET_ALL)
 
-        if not rm.push(zot_paths, []):
+        if not report.timed('remarkable.push', rm.push, [('add', i) for i in zot_paths], [],
+                            source=source(zot, mirror)):
             return False
 
         for file in zot_paths:
@@ -89,60 +283,674 @@ def initialize(zot, rm, dir):
               ": The script will assume that reMarkable and Zotero have " +
               "been previously synced.")
 
+    manifest.clear_plan()
+    report.changed(new = len(zot_paths))
+
+    return report.timed('record', lambda: zot.save_state() and record(zot, rm, manifest))
+
+
+def adopt(zot, rm, dir, manifest, mirror = True):
+    """
+    Initialize from the files already in the local directory
+    and in reMarkable instead of downloading and uploading
+    them again. Documents are matched to the Zotero files by
+    path, or by name when a single unmatched document has it,
+    and local files by md5. Only the files missing from one
+    end are transferred, and the mismatches are reported.
+
+    Args:
+        zot: Zotero instance
+        rm: ReMarkable instance
+        dir: local directory
+        manifest: Manifest of the synced files
+        mirror: keep a local copy of the files
+
+    Returns: True is success, False otherwise
+    """
+
+    os.makedirs(dir, exist_ok=True)
+
+    if not fetch(zot, rm):
+        return False
+
+    zot_paths = [i.path for i in zot.files]
+
+    # reMarkable documents at the path of a Zotero file,
+    # or with its name if no other document has it
+    rm_paths = {}
+    for file in rm.files:
+        rm_paths.setdefault(file.path, []).append(file)
+
+    names = {}
+    for path in rm_paths:
+        if path not in zot.by_path:
+            names.setdefault(os.path.basename(path), []).append(path)
+
+    to_move = []
+    to_upload = []
+
+    for path in zot_paths:
+        if path in rm_paths:
+            continue
+
+        candidates = names.get(os.path.basename(path), [])
+
+        if len(candidates) == 1:
+            to_move.append((candidates.pop(), path))
+        else:
+            to_upload.append(path)
+
+    moved = {old for old, _ in to_move}
+    duplicates = sorted(p for p, docs in rm_paths.items() if len(docs) > 1)
+    unmatched = sorted(p for p in rm_paths if p not in zot.by_path and p not in moved)
+
+    # Local files with the md5 reported by Zotero
+    to_download = []
+    differ = []
+    stray = []
+
+    if mirror:
+        local = scan_local_files(dir, manifest)
+
+        with ThreadPoolExecutor(max_workers=zot.workers) as pool:
+            hashed = dict(zip([p for p in zot_paths if p in local],
+                              pool.map(file_md5, [os.path.join(dir, p)
+                                                  for p in zot_paths if p in local])))
+
+        for file in zot.files:
+            if file.path not in hashed:
+                to_download.append(file.path)
+
+            elif file.md5 and file.md5 != hashed[file.path][0]:
+                differ.append(file.path)
+                to_download.append(file.path)
+
+            else:
+                zot.downloaded[file.path] = hashed[file.path]
+
+        stray = sorted(p for p in local if p not in zot.by_path)
+
+    print(Fore.GREEN +
+          f"Adopting {len(zot_paths) - len(to_upload)} reMarkable documents" +
+          (f" and {len(zot_paths) - len(to_download)} local files" if mirror else "") +
+          Style.RESET_ALL)
+
+    for old, new in to_move:
+        print(Fore.YELLOW + f"\t Matched by name, moving in reMarkable: {old} -> {new}" +
+              Style.RESET_ALL)
+
+    for path in duplicates:
+        print(Fore.YELLOW + f"\t Duplicate in reMarkable, keeping the first: {path}" +
+              Style.RESET_ALL)
+
+    for path in unmatched:
+        print(Fore.YELLOW + f"\t Not in Zotero, left in reMarkable: {path}" +
+              Style.RESET_ALL)
+
+    for path in differ:
+        print(Fore.YELLOW + f"\t Local copy differs from Zotero, downloading: {path}" +
+              Style.RESET_ALL)
+
+    for path in stray:
+        print(Fore.YELLOW + f"\t Not in Zotero, left in local directory: {path}" +
+              Style.RESET_ALL)
+
+    for old, new in to_move:
+        try:
+            rm.move(rm.find(old), new)
+
+        except Exception as ex:
+            print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+            return False
+
+    if to_download:
+        print(Fore.GREEN +
+              f"Downloading {len(to_download)} files..." +
+              Style.RESET_ALL)
+
+        if not report.timed('zotero.pull', zot.pull, [('add', i) for i in to_download], []):
+            return False
+
+    if to_upload:
+        print(Fore.GREEN +
+              f"Uploading {len(to_upload)} files to reMarkable..." +
+              Style.RESET_ALL)
+
+        if not report.timed('remarkable.push', rm.push, [('add', i) for i in to_upload], [],
+                            source=source(zot, mirror)):
+            return False
+
+    manifest.clear_plan()
+    report.changed(new = len(to_upload),
+                   moved = len(to_move),
+                   updated = len(differ))
+
+    return report.timed('record', lambda: zot.save_state() and record(zot, rm, manifest))
+
+
+def fetch(zot, rm):
+    """
+    Fetch Zotero and reMarkable at the same time, so
+    a sync without changes waits for a single round trip
+
+    Args:
+        zot: Zotero instance
+        rm: ReMarkable instance
+
+    Returns: True is success, False otherwise
+    """
+
+    timed = report.bind(report.timed)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        fetched = [pool.submit(timed, 'zotero.fetch', zot.fetch),
+                   pool.submit(timed, 'remarkable.fetch', rm.fetch)]
+
+        return all([i.result() for i in fetched])
+
+
+def source(zot, mirror, budget = None):
+    """
+    Where ReMarkable.push reads the files to upload from
+
+    Args:
+        zot: Zotero instance
+        mirror: keep a local copy of the files
+        budget: Budget of the run spending the downloaded bytes
+
+    Returns: None to read them from the local directory,
+             a function to download them from Zotero otherwise
+    """
+
+    if mirror:
+        return None
+
+    def download(file, file_path):
+        zot.download_file(file, file_path)
+
+        if budget is not None:
+            budget.spend(zot.downloaded[file][1])
+
+    return download
+
+
+def open_manifest(dir):
+    """
+    Open the manifest of the synced files, stored next to
+    the local directory. A new manifest is filled in from
+    the files of the local directory synced by previous
+    versions, if any.
+
+    Args:
+        dir: local directory
+
+    Returns: Manifest instance
+    """
+
+    manifest = Manifest(f"{os.path.normpath(dir)}.sqlite")
+
+    if len(manifest) == 0 and os.path.exists(dir):
+        manifest.replace([{'path': path} for path in scan_local_files(dir, manifest)])
+
+    return manifest
+
+
+def restore(zot, dir, manifest, skip = (), budget = None):
+    """
+    Download again the synced files missing from the local
+    directory, or whose size is not the synced one. The
+    scan only lists the directories that changed.
+
+    Args:
+        zot: Zotero instance
+        dir: local directory
+        manifest: Manifest of the synced files
+        skip: paths that are going to be downloaded or deleted
+        budget: Budget of the run, the files left are
+                restored by the next run
+
+    Returns: True is success, False otherwise
+    """
+
+    local = scan_local_files(dir, manifest) if os.path.exists(dir) else {}
+    skip = set(skip)
+    rows = manifest.rows()
+
+    missing = sorted([path for path, row in rows.items()
+                      if path in zot.by_path and path not in skip and
+                      (path not in local or
+                       row['size'] is not None and local[path][0] != row['size'])],
+                     key=lambda i: priority(zot.by_path[i], rows[i]['size']))
+
+    if not missing:
+        return True
+
+    print(Fore.YELLOW +
+          f"Restoring {len(missing)} files to the local directory." +
+          Style.RESET_ALL)
+
+    return zot.pull([('add', i) for i in missing], [], budget=budget)
+
+
+def unmanage(zot, manifest):
+    """
+    Stop syncing the files that left the scope of the
+    sync rules. Their rows are moved to the unmanaged
+    files of the manifest, their local copies and their
+    reMarkable documents are left in place instead of
+    being deleted. Unmanaged files back in scope are
+    synced again from the next run.
+
+    Args:
+        zot: Zotero instance
+        manifest: Manifest of the synced files
+
+    Returns: set of the paths and set of the
+             reMarkable IDs out of scope
+    """
+
+    excluded = {path for paths in zot.excluded.values() for path in paths}
+
+    # Attachments with other paths in scope were moved
+    keys = {i.id for i in zot.files}
+
+    out = [path for path, row in manifest.rows().items()
+           if path not in zot.by_path and
+           (path in excluded or not zot.scope.file(path) or
+            row['zot_key'] in zot.excluded and row['zot_key'] not in keys)]
+
+    for path in out:
+        manifest.unmanage(path)
+
+        print(Fore.YELLOW +
+              f"\t Out of scope, no longer synced: {path}" +
+              Style.RESET_ALL)
+
+    # The paths of the attachments excluded by the API
+    # are not known, the unmanaged files are kept out
+    # of the comparison by path and by ID
+    unmanaged = manifest.unmanaged()
+
+    manifest.readmit([i['path'] for i in unmanaged
+                      if i['path'] in zot.by_path or i['zot_key'] in keys])
+
+    return (excluded | {i['path'] for i in unmanaged},
+            {i['rm_id'] for i in unmanaged if i['rm_id']})
+
+
+def row(zot, rm, file, old):
+    """
+    Manifest row of a synced file: the Zotero key and
+    version, the reMarkable ID and version, and the md5
+    and size of the file
+
+    Args:
+        zot: Zotero instance
+        rm: ReMarkable instance
+        file: Zotero File
+        old: previous row of the file, {} if none
+
+    Returns: dict with the columns of the row
+    """
+
+    doc = rm.find(file.path)
+    md5, size = zot.downloaded.get(file.path, (old.get('md5'), old.get('size')))
+
+    # Keep the md5 reported by Zotero, the one
+    # compared to detect modified files
+    md5 = file.md5 or md5
+
+    return {'path': file.path,
+            'zot_key': file.id,
+            'rm_id': doc.ID if doc else old.get('rm_id'),
+            'md5': md5,
+            'size': size,
+            'zot_version': file.version,
+            'zot_mtime': file.mtime,
+            'rm_version': doc.Version if doc else old.get('rm_version')}
+
+
+def record(zot, rm, manifest):
+    """
+    Record in the manifest the files synced in this run
+
+    Args:
+        zot: Zotero instance
+        rm: ReMarkable instance
+        manifest: Manifest of the synced files
+
+    Returns: True is success, False otherwise
+    """
+
+    old_rows = manifest.rows()
+    rows = [row(zot, rm, file, old_rows.get(file.path, {})) for file in zot.files]
+
+    try:
+        manifest.replace(rows)
+
+    except Exception as ex:
+        print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+        return False
+
     return True
 
 
-def sync(zot, rm, dir, quiet = False):
+def committer(zot, rm, manifest, plan, side, stage):
+    """
+    Function that commits the completed operations of
+    a plan, in the manifest and in the given plan. Once
+    pushed, the changes of Zotero are also recorded in
+    the manifest, and the files deleted in reMarkable
+    are removed from it.
+
+    Args:
+        zot: Zotero instance
+        rm: ReMarkable instance
+        manifest: Manifest of the synced files
+        plan: list of the operations of the plan
+        side: 'zot' or 'rm', where the changes were made
+        stage: 'pulled' or 'pushed'
+
+    Returns: function called with the op and the path
+             of every completed operation
+    """
+
+    sources = {i['path']: i['source'] for i in plan if i['op'] == 'move'}
+    ops = {(i['side'], i['op'], i['path']): i for i in plan}
+
+    def commit(op, path):
+        if stage == 'pushed':
+            if side == 'rm' or op == 'delete':
+                manifest.delete(path)
+
+            else:
+                if op == 'move':
+                    manifest.move(sources[path], path)
+
+                fields = row(zot, rm, zot.by_path[path], manifest.get(path))
+                manifest.put(fields.pop('path'), **fields)
+
+        manifest.done(side, op, path, stage)
+
+        if (side, op, path) in ops:
+            ops[(side, op, path)][stage] = True
+
+    return commit
+
+
+def select(plan, side, op, stage):
+    """
+    Operations of a plan that have not completed a stage
+
+    Args:
+        plan: list of the operations of the plan
+        side: 'zot' or 'rm'
+        op: 'add', 'delete', 'move' or 'update'
+        stage: 'pulled' or 'pushed'
+
+    Returns: list of paths, (source, path) for moves
+    """
+
+    return [(i['source'], i['path']) if op == 'move' else i['path']
+            for i in plan
+            if (i['side'] == side) & (i['op'] == op) & (not i[stage])]
+
+
+def transfers(plan, stage):
+    """
+    Transfers of a plan that have not completed a stage:
+    the files added or modified in Zotero
+
+    Args:
+        plan: list of the operations of the plan
+        stage: 'pulled' or 'pushed'
+
+    Returns: list of (op, path), in the order of the plan
+    """
+
+    return [(i['op'], i['path']) for i in plan
+            if (i['side'] == 'zot') & (i['op'] in ('add', 'update')) & (not i[stage])]
+
+
+def rank(zot, rows, op):
+    """
+    Order of the operations of a plan: moves and deletes
+    first, then the transfers of the files added or
+    modified in Zotero, in the order of their priority
+
+    Args:
+        zot: Zotero instance
+        rows: dict path -> manifest row of the synced files
+        op: operation of the plan
+
+    Returns: sort key of the operation
+    """
+
+    if (op['side'] != 'zot') | (op['op'] not in ('add', 'update')):
+        return (0,)
+
+    return (1,) + priority(zot.by_path[op['path']], rows.get(op['path'], {}).get('size'))
+
+
+def execute(zot, rm, manifest, plan, mirror = True, budget = None):
+    """
+    Execute the operations of a plan, committing every
+    completed one so an interrupted sync can be resumed
+
+    Args:
+        zot: Zotero instance
+        rm: ReMarkable instance
+        manifest: Manifest of the synced files
+        plan: list of the operations of the plan
+        mirror: keep a local copy of the files
+        budget: Budget of the run, the operations left
+                once it is exhausted stay in the plan
+
+    Returns: True is success, False otherwise
+    """
+
+    budget = budget or Budget()
+
+    # Files removed from Zotero since the plan was
+    # made are left to the next comparison
+    plan = [i for i in plan
+            if (i['side'] == 'rm') | (i['op'] == 'delete') | (i['path'] in zot.by_path)]
+
+    rows = manifest.rows()
+    plan.sort(key=lambda i: rank(zot, rows, i))
+
+    # A bounded run pulls and pushes the files in
+    # batches of one file per worker, so the files
+    # downloaded before the budget is exhausted
+    # also reach reMarkable
+    size = max(zot.workers, rm.workers) if mirror and budget.limited else max(1, len(plan))
+
+    for batch in [plan[i:i + size] for i in range(0, len(plan), size)]:
+        # Only transfers are left
+        if budget.exhausted and rank(zot, rows, batch[0])[0]:
+            break
+
+        if mirror:
+            to_transfer = transfers(batch, 'pulled')
+            to_delete, to_move = [select(batch, 'zot', op, 'pulled') for op in ('delete', 'move')]
+
+            if to_transfer or to_delete or to_move:
+                if not report.timed('zotero.pull', zot.pull, to_transfer, to_delete, to_move,
+                                    committer(zot, rm, manifest, batch, 'zot', 'pulled'), budget):
+                    return False
+
+            # The operations left by the pull stay for the next run,
+            # the ones pulled are pushed even if the budget is spent
+            batch = [i for i in batch if (i['side'] != 'zot') | i['pulled']]
+
+        to_transfer = transfers(batch, 'pushed')
+        to_delete, to_move = [select(batch, 'zot', op, 'pushed') for op in ('delete', 'move')]
+
+        if to_transfer or to_delete or to_move:
+            rm_ids = {old: manifest.get(old).get('rm_id') for old, new in to_move}
+            rm_ids.update({path: manifest.get(path).get('rm_id')
+                           for op, path in to_transfer if op == 'update'})
+
+            if not report.timed('remarkable.push', rm.push, to_transfer, to_delete, to_move,
+                                rm_ids, source(zot, mirror, budget),
+                                committer(zot, rm, manifest, batch, 'zot', 'pushed'), budget):
+                return False
+
+    if mirror:
+        to_add, to_delete = [select(plan, 'rm', op, 'pulled') for op in ('add', 'delete')]
+
+        if to_add or to_delete:
+            if not report.timed('remarkable.pull', rm.pull, to_add, to_delete,
+                                committer(zot, rm, manifest, plan, 'rm', 'pulled')):
+                return False
+
+    to_add, to_delete = [select(plan, 'rm', op, 'pushed') for op in ('add', 'delete')]
+
+    if to_add or to_delete:
+        if not report.timed('zotero.push', zot.push, to_add, to_delete,
+                            committer(zot, rm, manifest, plan, 'rm', 'pushed')):
+            return False
+
+    # The stored files of the local files replaced or
+    # deleted by the plan, unless other paths link them
+    if mirror:
+        try:
+            zot.collect([rows[i['path']]['md5'] for i in plan
+                         if i['op'] in ('update', 'delete') and rows.get(i['path'], {}).get('md5')])
+
+        except Exception as ex:
+            print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+            return False
+
+    return True
+
+
+def left(manifest, budget, total):
+    """
+    Check if a bounded run stopped before
+    completing the operations of its plan
+
+    Args:
+        manifest: Manifest of the synced files
+        budget: Budget of the run
+        total: operations of the plan
+
+    Returns: True if operations are left for the next run
+    """
+
+    pending = len(manifest.load_plan())
+
+    if not (budget.exhausted and pending):
+        return False
+
+    print(Fore.YELLOW +
+          f"Budget exhausted, {total - pending} of {total} operations done, " +
+          f"{pending} left for the next run." +
+          Style.RESET_ALL)
+
+    return True
+
+
+def sync(zot, rm, dir, manifest, quiet = False, mirror = True, budget = None):
     """
     Synchronize Zotero library and reMarkable
 
+    The plan of the sync is saved in the manifest before
+    it is executed, and every completed operation is
+    committed. The plan of an interrupted sync is
+    finished before the new changes are compared. A
+    bounded run stops once its budget is exhausted, the
+    operations left stay in the plan for the next run.
+
     Args:
         zot: Zotero instance
         rm: ReMarkable instance
         dir: local directory
+        manifest: Manifest of the synced files
         quiet: quiet mode, no prints
+        mirror: keep a local copy of the files
+        budget: Budget of the run
     """
 
-    if not zot.fetch():
-        return False
+    budget = budget or Budget()
 
-    if not rm.fetch():
+    if not fetch(zot, rm):
         return False
 
-    local_paths = [i[len(dir):] for i in list_local_files(dir)]
-    zot_paths = [i.path for i in zot.files]
-    rm_paths = [i.path for i in rm.files]
+    plan = manifest.load_plan()
+
+    if plan:
+        print(Fore.YELLOW +
+              f"Resuming interrupted sync, {len(plan)} pending operations." +
+              Style.RESET_ALL)
+
+        with report.phase('resume'):
+            if not execute(zot, rm, manifest, plan, mirror, budget):
+                return False
+
+        if left(manifest, budget, len(plan)):
+            return True
+
+        manifest.clear_plan()
+
+        # Fetch again the changes made while resuming
+        if not fetch(zot, rm):
+            return False
+
+    # Compare Zotero and reMarkable to the manifest of
+    # the last sync to check if there are changes in
+    # any of the ends. Files are identified by their
+    # Zotero key and their reMarkable ID, so moves and
+    # renames are detected.
+    with report.phase('diff'):
+        unmanaged, unmanaged_ids = unmanage(zot, manifest)
+        rm_files = [i for i in rm.files
+                    if i.path not in unmanaged and i.id not in unmanaged_ids and
+                    zot.scope.file(i.path)]
 
-    # Compare Zotero and reMarkable to the local folder
-    # to check if there are changes in any of the ends
-    to_add_zot, to_delete_zot = compare(zot_paths, local_paths)
-    to_add_rm, to_delete_rm = compare(rm_paths, local_paths)
+        to_add_zot, to_delete_zot, to_move_zot, to_update_zot = diff(zot.files, manifest, 'zot_key')
+        to_add_rm, to_delete_rm, to_move_rm, _ = diff(rm_files, manifest, 'rm_id')
+
+    if mirror:
+        with report.phase('local'):
+            if not restore(zot, dir, manifest, to_update_zot + to_delete_rm, budget):
+                return False
+
+    report.changed(new = len(to_add_zot) + len(to_add_rm),
+                   moved = len(to_move_zot),
+                   updated = len(to_update_zot),
+                   deleted = len(to_delete_zot) + len(to_delete_rm))
 
     if ((len(to_add_zot) == 0) &
         (len(to_delete_zot) == 0) &
+        (len(to_move_zot) == 0) &
+        (len(to_update_zot) == 0) &
         (len(to_add_rm) == 0) &
         (len(to_delete_rm) == 0)):
         print('Up to date.')
-        return True
 
-    if ((len(to_add_zot) != 0) |
-        (len(to_delete_zot) != 0)):
+        # Nothing to record if Zotero did not change since
+        # the saved state and every file has its identities
+        if zot.version is not None and zot.version == zot.saved and manifest.complete():
+            return True
 
-        if not zot.pull(to_add_zot, to_delete_zot):
-            return False
-
-        if not rm.push(to_add_zot, to_delete_zot):
-            return False
+        return report.timed('record', lambda: zot.save_state() and record(zot, rm, manifest))
 
-    if ((len(to_add_rm) != 0) |
-        (len(to_delete_rm) != 0)):
+    manifest.save_plan([{'side': 'zot', 'op': 'add', 'path': i} for i in to_add_zot] +
+                       [{'side': 'zot', 'op': 'delete', 'path': i} for i in to_delete_zot] +
+                       [{'side': 'zot', 'op': 'move', 'path': new, 'source': old}
+                        for old, new in to_move_zot] +
+                       [{'side': 'zot', 'op': 'update', 'path': i} for i in to_update_zot] +
+                       [{'side': 'rm', 'op': 'add', 'path': i} for i in to_add_rm] +
+                       [{'side': 'rm', 'op': 'delete', 'path': i} for i in to_delete_rm])
 
-        if not rm.pull(to_add_rm, to_delete_rm):
-            return False
+    plan = manifest.load_plan()
 
-        if not zot.push(to_add_rm, to_delete_rm):
-            return False
+    if not execute(zot, rm, manifest, plan, mirror, budget):
+        return False
 
+    if left(manifest, budget, len(plan)):
+        return True
 
     if not quiet:
         for file in to_add_zot:
@@ -150,11 +958,26 @@ def sync(zot, rm, dir, quiet = False):
                   f"\t New to reMarkable: {file}" +
                   Style.RESET_ALL)
 
+        for old, new in to_move_zot:
+            print(Fore.GREEN +
+                  f"\t Moved in reMarkable: {old} -> {new}" +
+                  Style.RESET_ALL)
+
+        for file in to_update_zot:
+            print(Fore.GREEN +
+                  f"\t Updated in reMarkable: {file}" +
+                  Style.RESET_ALL)
+
         for file in to_add_rm:
             print(Fore.GREEN +
                   f"\t New to Zotero: {file}" +
                   Style.RESET_ALL)
 
+        for old, new in to_move_rm:
+            print(Fore.YELLOW +
+                  f"\t Moved in reMarkable, not synced to Zotero: {old} -> {new}" +
+                  Style.RESET_ALL)
+
         for file in to_delete_zot:
             print(Fore.RED +
                   f"\t Deleted in reMarkable: {file}" +
@@ -169,37 +992,240 @@ def sync(zot, rm, dir, quiet = False):
           f"{len(to_add_zot) + len(to_add_rm)} new files." +
           Style.RESET_ALL)
 
+    print(Fore.GREEN +
+          f"{len(to_move_zot)} moved files." +
+          Style.RESET_ALL)
+
+    print(Fore.GREEN +
+          f"{len(to_update_zot)} updated files." +
+          Style.RESET_ALL)
+
     print(Fore.RED +
           f"{len(to_delete_zot) + len(to_delete_rm)} deleted files." +
           Style.RESET_ALL)
 
+    if not report.timed('record', lambda: zot.save_state() and record(zot, rm, manifest)):
+        return False
+
+    manifest.clear_plan()
+
     return True
 
 
+def watch(zot, rm, dir, manifest, quiet = False, mirror = True,
+          interval = 30, max_interval = 900, after = None, budget = None):
+    """
+    Keep the clients and their indexes between syncs, and
+    sync every time the Zotero library version or the
+    generation of the reMarkable listing change, or the
+    last sync left operations for the next one. The wait
+    between checks doubles while nothing changes.
 
-def main():
-    args = get_args()
+    Args:
+        zot: Zotero instance
+        rm: ReMarkable instance
+        dir: local directory
+        manifest: Manifest of the synced files
+        quiet: quiet mode, no prints
+        mirror: keep a local copy of the files
+        interval: seconds between checks
+        max_interval: longest wait between checks
+        after: function called with the result of every sync
+        budget: Budget of every sync
+    """
+
+    budget = budget or Budget()
+    delay = interval
+    changed = failed = False
+
+    while True:
+        try:
+            # The user token expires while watching, it is
+            # renewed before it does and after a failure
+            rm.renew_token(force=failed)
+
+            # Both are checked, the new reMarkable snapshot
+            # is the one synced. A failed sync is retried.
+            changed = zot.changed() | rm.changed() | failed | bool(manifest.load_plan())
+
+            if changed:
+                budget.reset()
+
+            failed = not sync(zot, rm, dir, manifest, quiet, mirror, budget) if changed else False
+
+            # The changes of the sync are not changes to sync
+            if changed and not failed:
+                rm.checkpoint()
+
+        except Exception as ex:
+            print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+            failed = True
+
+        if failed:
+            print(Fore.RED + "Synchronization Error." + Style.RESET_ALL)
+
+        if after is not None and (changed or failed):
+            after(not failed)
+
+        if changed and not failed:
+            delay = interval
+        else:
+            delay = min(delay * 2, max_interval)
+
+        time.sleep(delay)
+
+
+def open_target(options, shared = None):
+    """
+    Open the Zotero library, the reMarkable directory
+    and the manifest of a target
+
+    Args:
+        options: dict with the options of the target
+        shared: ReMarkable instance whose client and
+                metadata snapshot are reused, if any
+
+    Returns: (Zotero, ReMarkable, local directory, Manifest)
+    """
 
     local_dir = os.path.join(os.path.expanduser('~'),
-                    '.zot_rm_sync', args.directory)
+                    '.zot_rm_sync', options['directory'])
+
+    scope = Scope(include_collections = options['include_collection'],
+                  exclude_collections = options['exclude_collection'],
+                  include_tags = options['include_tag'],
+                  exclude_tags = options['exclude_tag'],
+                  include_types = options['include_item_type'],
+                  exclude_types = options['exclude_item_type'])
+
+    if options['zot_backend'] == 'local':
+        zot = ZoteroLocal(dir = local_dir,
+                          zot_data_dir = options['zot_data_dir'],
+                          workers = options['zot_workers'],
+                          scope = scope)
+
+    else:
+        zot = Zotero(dir = local_dir,
+                     zot_library_id = options['zot_library_id'],
+                     zot_api_key = options['zot_api_key'],
+                     fetch_mode = options['zot_fetch_mode'],
+                     workers = options['zot_workers'],
+                     library_type = options['zot_library_type'],
+                     scope = scope)
+
+    if shared is not None:
+        rm = shared.target(local_dir, options['directory'], options['rm_workers'])
+    else:
+        rm = ReMarkable(local_dir = local_dir,
+                        reMarkable_dir = options['directory'],
+                        workers = options['rm_workers'])
+
+    return zot, rm, local_dir, open_manifest(local_dir)
+
+
+def run(options, zot, rm, local_dir, manifest, dump = None, budget = None):
+    """
+    Initialize, sync or watch a target
+
+    Args:
+        options: dict with the options of the target
+        zot: Zotero instance
+        rm: ReMarkable instance
+        local_dir: local directory
+        manifest: Manifest of the synced files
+        dump: function called with the result of every sync
+        budget: Budget of the run, of every sync while watching
+
+    Returns: error message, None if success
+    """
 
-    zot = Zotero(dir = local_dir,
-                 zot_library_id = args.zot_library_id,
-                 zot_api_key = args.zot_api_key)
+    mirror = not options['mirrorless']
+    error = None
 
-    rm = ReMarkable(local_dir = local_dir,
-                    reMarkable_dir = args.directory)
+    if options['initialize']:
+        init = adopt if options['adopt'] else initialize
 
-    if args.initialize:
-        if not initialize(zot, rm, local_dir):
-            sys.exit("Initialization Error.")
+        if not init(zot, rm, local_dir, manifest, mirror):
+            error = "Initialization Error."
 
     else:
-        if not os.path.exists(local_dir):
+        if len(manifest) == 0 and not os.path.exists(local_dir):
             print('Please initialize with --initialize')
 
-        if not sync(zot, rm, local_dir, args.quiet):
-            sys.exit("Synchronization Error.")
+        if options['watch']:
+            try:
+                watch(zot, rm, local_dir, manifest, options['quiet'], mirror,
+                      options['watch_interval'], options['watch_max_interval'], dump, budget)
+
+            except KeyboardInterrupt:
+                manifest.close()
+
+            return None
+
+        if not sync(zot, rm, local_dir, manifest, options['quiet'], mirror, budget):
+            error = "Synchronization Error."
+
+    if dump is not None:
+        dump(error is None)
+
+    return error
+
+
+def main():
+    args = get_args()
+
+    if args.report:
+        report.install()
+        report.reset()
+
+    def dump(success):
+        if args.report:
+            report.dump(args.report_file, success)
+            report.reset()
+
+    # Requests of pyzotero, rmapy and the transfers are rate
+    # limited, and retried when the servers ask to back off
+    scheduler.configure('zotero', rate = args.zot_rate, concurrency = args.zot_workers)
+    scheduler.configure('remarkable', rate = args.rm_rate, concurrency = args.rm_workers)
+
+    # A single budget for the whole run, shared by the targets
+    budget = Budget(args.max_duration, args.max_bytes)
+
+    profiler = Profiler() if args.profile else None
+
+    if profiler is not None:
+        profiler.enable()
+
+    if len(args.targets) == 1:
+        error = run(args.targets[0], *open_target(args.targets[0]), dump, budget)
+
+    else:
+        # The targets share the reMarkable client and its
+        # metadata snapshot, taken once before they run
+        targets = [open_target(args.targets[0])]
+        targets += [open_target(i, targets[0][1]) for i in args.targets[1:]]
+
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+            def run_target(i):
+                with report.target(args.targets[i]['directory']):
+                    return run(args.targets[i], *targets[i], budget=budget)
+
+            errors = list(pool.map(run_target, range(len(targets))))
+
+        failed = [f"{options['directory']}: {error}"
+                  for options, error in zip(args.targets, errors) if error is not None]
+
+        error = "\n".join(failed) if failed else None
+        dump(error is None)
+
+    if profiler is not None:
+        profiler.disable()
+        stats = profiler.stats(sys.stderr)
+        stats.dump_stats(args.profile)
+        stats.sort_stats('cumulative').print_stats(25)
+
+    if error is not None:
+        sys.exit(error)
 
 
 if __name__ == "__main__":
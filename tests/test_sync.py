@@ -0,0 +1,162 @@
+import os
+import json
+import sys
+import shutil
+import tempfile
+import requests
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync
+from benchmarks import run
+from benchmarks.fakes import FakeZotero, FakeReMarkable
+from utils.budget import Budget
+
+OPTIONS = {'zot_fetch_mode': 'library', 'workers': 4, 'zot_rate': 0, 'rm_rate': 0}
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.dir = os.path.join(self.root, 'Zotero')
+
+        self.zot_api = FakeZotero(3, 1, 8, 3000, 0)
+        self.rm_api = FakeReMarkable()
+        self.zot_api.start()
+        self.rm_api.start()
+
+        self.manifest = sync.open_manifest(self.dir)
+        self.assertTrue(sync.initialize(*self.connect(), self.dir, self.manifest))
+
+    def tearDown(self):
+        self.manifest.close()
+        self.zot_api.stop()
+        self.rm_api.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def connect(self, **options):
+        return run.connect(self.zot_api, self.rm_api, self.dir, {**OPTIONS, **options})
+
+    def test_delete_in_remarkable(self):
+        rm = self.connect()[1]
+        rm.fetch()
+        rm.delete([rm.by_id[i.id] for i in rm.files[:3]])
+
+        self.assertTrue(sync.sync(*self.connect(), self.dir, self.manifest, True))
+        self.assertEqual(len(self.manifest), 5)
+
+        zot, rm = self.connect()
+        self.assertTrue(sync.sync(zot, rm, self.dir, self.manifest, True))
+        self.assertEqual(len(self.manifest), 5)
+        self.assertEqual(len(zot.files), 5)
+
+    def test_resume_update(self):
+        handle = self.rm_api.handle
+        uploads = []
+
+        def failing(method, path, query, headers, body):
+            if path.startswith('/blob/'):
+                uploads.append(path)
+
+            # The previous document is not deleted
+            if path.endswith('/delete'):
+                return 200, {}, [{'ID': i['ID'], 'Success': False, 'Message': 'network down'}
+                                 for i in json.loads(body)]
+
+            return handle(method, path, query, headers, body)
+
+        key = next(iter(self.zot_api.attachments()))
+        self.zot_api.modify(key)
+        path = next(i for i, row in self.manifest.rows().items() if row['zot_key'] == key)
+        old_id = self.manifest.get(path)['rm_id']
+
+        self.rm_api.handle = failing
+        self.assertFalse(sync.sync(*self.connect(), self.dir, self.manifest, True))
+        self.rm_api.handle = handle
+        self.assertTrue(sync.sync(*self.connect(), self.dir, self.manifest, True))
+
+        rm = self.connect()[1]
+        rm.fetch()
+        docs = [i for i in rm.files if i.path == path]
+
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(len(docs), 1)
+        self.assertNotEqual(docs[0].id, old_id)
+        self.assertEqual(self.manifest.get(path)['rm_id'], docs[0].id)
+        self.assertEqual(self.manifest.load_plan(), [])
+
+    def test_watch_network_down(self):
+        results = []
+        zot, rm = self.connect()
+
+        # Two checks, then the watch is stopped
+        sleep = mock.Mock(side_effect=[None, KeyboardInterrupt])
+        send = mock.Mock(side_effect=requests.ConnectionError('network down'))
+
+        with mock.patch('time.sleep', sleep), mock.patch('requests.Session.send', send):
+            with self.assertRaises(KeyboardInterrupt):
+                sync.watch(zot, rm, self.dir, self.manifest, True, after=results.append)
+
+        self.assertEqual(results, [False, False])
+
+    def stored(self):
+        return {i for _, _, files in os.walk(self.dir + '.store') for i in files}
+
+    def test_collect(self):
+        key = next(iter(self.zot_api.attachments()))
+        path = next(i for i, row in self.manifest.rows().items() if row['zot_key'] == key)
+        old_md5 = self.manifest.get(path)['md5']
+        self.zot_api.modify(key)
+
+        self.assertTrue(sync.sync(*self.connect(), self.dir, self.manifest, True))
+
+        stored = {row['md5'] + '.pdf' for row in self.manifest.rows().values()}
+        self.assertNotIn(old_md5 + '.pdf', stored)
+        self.assertEqual(self.stored(), stored)
+
+    def test_collect_copies(self):
+        stored = self.stored()
+        self.zot_api.modify(next(iter(self.zot_api.attachments())))
+
+        # A file system without hardlinks
+        with mock.patch('os.link', side_effect=OSError):
+            self.assertTrue(sync.sync(*self.connect(), self.dir, self.manifest, True))
+
+        self.assertTrue(stored < self.stored())
+
+    def test_budget_order(self):
+        # A new target without a local copy
+        self.dir = os.path.join(self.root, 'Mirrorless')
+        manifest = sync.open_manifest(self.dir)
+        self.addCleanup(manifest.close)
+        self.rm_api.items.clear()
+        self.assertTrue(sync.initialize(*self.connect(), self.dir, manifest, False))
+
+        self.zot_api.add(next(iter(self.zot_api.collections)))
+        key = self.zot_api.attachments()[0]
+        self.zot_api.modify(key)
+
+        # The most recently modified file is transferred first
+        self.assertTrue(sync.sync(*self.connect(workers = 1), self.dir, manifest, True, False,
+                                  Budget(max_bytes = 1)))
+        self.assertEqual([(i['op'], i['path']) for i in manifest.load_plan()],
+                         [('add', 'collection-0000/paper-000008.pdf')])
+
+    def test_budget_pulled(self):
+        for collection in list(self.zot_api.collections)[:2] * 3:
+            self.zot_api.add(collection)
+
+        self.assertTrue(sync.sync(*self.connect(), self.dir, self.manifest, True, True,
+                                  Budget(max_bytes = 1)))
+
+        # The files downloaded also reach reMarkable
+        plan = self.manifest.load_plan()
+        self.assertTrue(0 < len(plan) < 6)
+        self.assertEqual([i for i in plan if i['pulled']], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import sys
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync
+from utils.zotero_local import ZoteroLocal
+from utils.remarkable import ReMarkable
+from benchmarks.fakes import FakeReMarkable
+from benchmarks.run import TOKEN
+
+# Tables of zotero.sqlite read by ZoteroLocal
+SCHEMA = """
+CREATE TABLE libraries (libraryID INTEGER PRIMARY KEY, type TEXT);
+CREATE TABLE collections (collectionID INTEGER PRIMARY KEY, collectionName TEXT,
+                          parentCollectionID INT, libraryID INT, key TEXT);
+CREATE TABLE collectionItems (collectionID INT, itemID INT);
+CREATE TABLE itemTypes (itemTypeID INTEGER PRIMARY KEY, typeName TEXT);
+CREATE TABLE items (itemID INTEGER PRIMARY KEY, itemTypeID INT, dateAdded TEXT,
+                    dateModified TEXT, libraryID INT, key TEXT, version INT);
+CREATE TABLE itemAttachments (itemID INTEGER PRIMARY KEY, parentItemID INT, linkMode INT,
+                              contentType TEXT, path TEXT, storageModTime INT,
+                              storageHash TEXT);
+CREATE TABLE fields (fieldID INTEGER PRIMARY KEY, fieldName TEXT);
+CREATE TABLE itemData (itemID INT, fieldID INT, valueID INT);
+CREATE TABLE itemDataValues (valueID INTEGER PRIMARY KEY, value TEXT);
+CREATE TABLE deletedItems (itemID INTEGER PRIMARY KEY);
+CREATE TABLE deletedCollections (collectionID INTEGER PRIMARY KEY);
+CREATE TABLE tags (tagID INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE itemTags (itemID INT, tagID INT);
+"""
+
+def fixture(data_dir, attachments):
+    """
+
+    Write a Zotero data directory with a collection
+    Papers and its subcollection Papers/ML
+
+    Args:
+        data_dir: Zotero data directory
+        attachments: list of (key, title, collection, content),
+                     content None if the file is not downloaded
+
+    """
+
+    db = sqlite3.connect(os.path.join(data_dir, 'zotero.sqlite'))
+    db.executescript(SCHEMA)
+    db.execute("INSERT INTO libraries VALUES (1, 'user')")
+    db.execute("INSERT INTO collections VALUES (1, 'Papers', NULL, 1, 'COLL0001')")
+    db.execute("INSERT INTO collections VALUES (2, 'ML', 1, 1, 'COLL0002')")
+    db.execute("INSERT INTO itemTypes VALUES (1, 'attachment')")
+    db.execute("INSERT INTO fields VALUES (1, 'title')")
+
+    for i, (key, title, collection, content) in enumerate(attachments, 1):
+        db.execute("INSERT INTO items VALUES (?, 1, ?, ?, 1, ?, ?)",
+                   (i, f'2021-01-0{i} 00:00:00', f'2021-01-0{i} 00:00:00', key, i))
+        db.execute("INSERT INTO itemAttachments VALUES (?, NULL, 2, 'application/pdf', ?, 0, ?)",
+                   (i, f'storage:{title}',
+                    hashlib.md5(content).hexdigest() if content is not None else None))
+        db.execute("INSERT INTO itemDataValues VALUES (?, ?)", (i, title))
+        db.execute("INSERT INTO itemData VALUES (?, 1, ?)", (i, i))
+        db.execute("INSERT INTO collectionItems VALUES (?, ?)", (collection, i))
+
+        if content is not None:
+            os.makedirs(os.path.join(data_dir, 'storage', key))
+
+            with open(os.path.join(data_dir, 'storage', key, title), 'wb') as f:
+                f.write(content)
+
+    db.commit()
+    db.close()
+
+
+class TestZoteroLocal(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.root, 'Zotero')
+        self.dir = os.path.join(self.root, 'sync', 'Papers')
+        os.makedirs(self.data_dir)
+
+        fixture(self.data_dir, [('AAAA0001', 'a.pdf', 1, b'%PDF-1.4\na'),
+                                ('AAAA0002', 'b.pdf', 2, b'%PDF-1.4\nbb'),
+                                ('AAAA0003', 'c.pdf', 2, None)])
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_fetch(self):
+        zot = ZoteroLocal(self.dir, self.data_dir)
+
+        self.assertTrue(zot.fetch())
+        self.assertEqual(sorted(i.path for i in zot.files), ['Papers/ML/b.pdf', 'Papers/a.pdf'])
+        self.assertEqual(zot.excluded, {'AAAA0003': ['Papers/ML/c.pdf']})
+        self.assertEqual(zot.by_path['Papers/a.pdf'].md5,
+                         hashlib.md5(b'%PDF-1.4\na').hexdigest())
+
+    def test_download(self):
+        zot = ZoteroLocal(self.dir, self.data_dir)
+        zot.fetch()
+
+        path = os.path.join(self.root, 'b.pdf')
+        md5, size = zot.download('AAAA0002', path)
+
+        self.assertEqual((md5, size), (hashlib.md5(b'%PDF-1.4\nbb').hexdigest(), 11))
+
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'%PDF-1.4\nbb')
+
+    def test_sync_missing_file(self):
+        import rmapy.api
+
+        rm_api = FakeReMarkable()
+        rm_api.start()
+        self.addCleanup(rm_api.stop)
+
+        rmapy.api.BASE_URL = rm_api.url
+        rmapy.api.USER_TOKEN_URL = f'{rm_api.url}/token/json/2/user/new'
+        rmapy.api.load = lambda: {'devicetoken': 'device-token', 'usertoken': TOKEN}
+        rmapy.api.dump = lambda config: None
+
+        manifest = sync.open_manifest(self.dir)
+        self.addCleanup(manifest.close)
+
+        def connect():
+            return ZoteroLocal(self.dir, self.data_dir), ReMarkable(self.dir, 'Papers')
+
+        self.assertTrue(sync.initialize(*connect(), self.dir, manifest))
+        self.assertEqual(sorted(manifest.rows()), ['Papers/ML/b.pdf', 'Papers/a.pdf'])
+
+        # Zotero desktop downloads the missing file
+        os.makedirs(os.path.join(self.data_dir, 'storage', 'AAAA0003'))
+
+        with open(os.path.join(self.data_dir, 'storage', 'AAAA0003', 'c.pdf'), 'wb') as f:
+            f.write(b'%PDF-1.4\nccc')
+
+        self.assertTrue(sync.sync(*connect(), self.dir, manifest, True))
+        self.assertEqual(len(manifest), 3)
+        self.assertEqual(manifest.load_plan(), [])
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'Papers/ML/c.pdf')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import time
+import threading
+
+class Budget():
+
+    def __init__(self, max_duration = None, max_bytes = None):
+        """
+
+        Limits of a run: the seconds it can last and the
+        bytes of the files it can transfer, downloaded from
+        Zotero or uploaded to reMarkable. Transfers are not
+        started once the budget is exhausted, the ones
+        running are finished.
+
+        Args:
+            max_duration: seconds from now, None for no limit
+            max_bytes: bytes to transfer, None for no limit
+
+        """
+
+        self.max_duration = max_duration
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+
+        Start the budget again from now
+
+        """
+
+        with self.lock:
+            self.started = time.monotonic()
+            self.spent = 0
+
+    @property
+    def limited(self):
+        """
+
+        Whether there is a time or a byte limit
+
+        """
+
+        return self.max_duration is not None or self.max_bytes is not None
+
+    @property
+    def exhausted(self):
+        """
+
+        Whether the time or the bytes of the budget are used up
+
+        """
+
+        if self.max_duration is not None and \
+                time.monotonic() - self.started >= self.max_duration:
+            return True
+
+        return self.max_bytes is not None and self.spent >= self.max_bytes
+
+    def spend(self, size):
+        """
+
+        Args:
+            size: bytes of a completed transfer
+
+        """
+
+        with self.lock:
+            self.spent += size
@@ -1,36 +1,177 @@
 import os
+import json
+import time
+import calendar
+import hashlib
+from colorama import Fore, Style
+
+# Seconds after which the mtime of a directory is trusted
+RACY_SECONDS = 2
 
 class File():
-    def __init__(self, path, item_id = None, parent_id = None):
+    def __init__(self, path, item_id = None, parent_id = None, version = None,
+                 md5 = None, mtime = None, date = None, size = None):
         """
         Initizalize the file information
 
         Args:
-            dir: reMarkable directory
+            path: path of the file in the synced directory
+            item_id: Zotero key or reMarkable ID of the file
+            parent_id: Zotero key of the parent item
+            version: Zotero or reMarkable version of the file
+            md5: md5 of the content of the file, if known
+            mtime: modification time of the content of the file, if known
+            date: timestamp of the last change of the item in Zotero, if known
+            size: size of the file, if known
         """
 
         self.path = path
         self.id = item_id
         self.parent = parent_id
+        self.version = version
+        self.md5 = md5
+        self.mtime = mtime
+        self.date = date
+        self.size = size
 
-def list_local_files(directory):
+def scan_local_files(directory, manifest):
     """
-    List all the files in a local directory
+    List all the files in a local directory, with the stat
+    metadata cached in the manifest. Only the directories
+    modified since the last scan are listed again, files
+    are written by renaming them into place so adding,
+    replacing or removing one modifies its directory.
 
     Args:
         directory: local directory
+        manifest: Manifest caching the scans
+
+    Returns: dict path -> (size, mtime_ns, inode) of the files,
+             paths relative to the directory
+    """
+
+    dirs, files = manifest.local()
+
+    children = {}
+    for path in files:
+        children.setdefault(os.path.dirname(path), []).append(path)
+
+    subdirs = {}
+    for path in dirs:
+        if path:
+            subdirs.setdefault(os.path.dirname(path), []).append(path)
+
+    # A directory modified again within the resolution of
+    # its mtime would look unchanged, recent ones are not
+    # trusted and are scanned again next time
+    racy = int((time.time() - RACY_SECONDS) * 1e9)
+
+    found = {}
+    scanned = {}
+    changed = {}
+    removed_files = set()
+    stack = ['']
+
+    while stack:
+        rel = stack.pop()
+
+        try:
+            mtime = os.stat(os.path.join(directory, rel)).st_mtime_ns
+
+        except FileNotFoundError:
+            continue
+
+        if dirs.get(rel) == mtime:
+            scanned[rel] = mtime
+            found.update((i, files[i]) for i in children.get(rel, []))
+            stack.extend(subdirs.get(rel, []))
+            continue
+
+        cached = set(children.get(rel, []))
+
+        with os.scandir(os.path.join(directory, rel)) as entries:
+            for entry in entries:
+                path = os.path.join(rel, entry.name) if rel else entry.name
+
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(path)
+
+                elif entry.is_file():
+                    stat = entry.stat()
+                    found[path] = (stat.st_size, stat.st_mtime_ns, entry.inode())
+                    cached.discard(path)
+
+                    if files.get(path) != found[path]:
+                        changed[path] = found[path]
+
+        removed_files |= cached
+        scanned[rel] = mtime if mtime < racy else None
+
+    removed_dirs = set(dirs) - set(scanned)
+    removed_files |= {i for i in files if os.path.dirname(i) in removed_dirs}
+
+    manifest.update_local({k: v for k, v in scanned.items() if dirs.get(k, 0) != v},
+                          changed, removed_dirs, removed_files)
+
+    return found
+
+def file_md5(file_path):
+    """
+    Hash a local file
+
+    Args:
+        file_path: path of the file
+
+    Returns: (md5, size) of the file
+    """
+
+    md5 = hashlib.md5()
+    size = 0
+
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+            size += len(chunk)
+
+    return md5.hexdigest(), size
+
+def timestamp(date):
+    """
+    Parse a Zotero date, like "2021-02-03T04:05:06Z"
+    from the API or "2021-02-03 04:05:06" from the
+    local database, both in UTC
+
+    Args:
+        date: Zotero date
+
+    Returns: seconds since the epoch, None if the date is not valid
+    """
+
+    try:
+        return calendar.timegm(time.strptime(date.rstrip('Z').replace('T', ' '),
+                                             '%Y-%m-%d %H:%M:%S'))
+
+    except (AttributeError, ValueError):
+        return None
 
-    Returns: list of files in the local directory
+def priority(file, size = None):
     """
+    Order of the transfers: the files most recently added
+    or modified in Zotero first and, among the files of
+    the same date, the smallest ones first
 
-    list_of_files = []
+    Args:
+        file: File to transfer
+        size: size of the file if it is not known by the File
+
+    Returns: sort key of the file
+    """
 
-    for path, dir, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(*path.split('/'), file)
-            list_of_files.append(file_path)
+    size = file.size if file.size is not None else size
 
-    return list_of_files
+    return (-(file.date or 0),
+            size if size is not None else float('inf'),
+            file.path)
 
 def compare(a, b):
     """
@@ -46,3 +187,106 @@ def compare(a, b):
     """
 
     return (list(set(a) - set(b)), list(set(b) - set(a)))
+
+def diff(files, manifest, field = 'zot_key'):
+    """
+    Compare the files of one end to the sync
+    manifest, detecting moves and renames by identity
+    and modified files by content hash
+
+    Args:
+        files: list of File of one end
+        manifest: Manifest of the synced files
+        field: manifest identity of the File ids,
+               'zot_key' or 'rm_id'
+
+    Returns: list of paths to add, list of paths
+             to delete, list of (old, new) moves
+             and list of modified paths
+    """
+
+    rows = manifest.rows()
+    to_add, to_delete = compare([i.path for i in files], rows.keys())
+
+    ids = {i.path: i.id for i in files}
+    deleted = set(to_delete)
+    to_move = []
+
+    for path in sorted(to_add):
+        for old in manifest.lookup(field, ids[path]):
+            if old in deleted:
+                deleted.remove(old)
+                to_move.append((old, path))
+                break
+
+    moved_to = {i[1] for i in to_move}
+
+    # The content of a file changed if its md5 differs
+    # from the synced one. The mtime is only used when
+    # there is no md5 to compare.
+    to_update = []
+
+    for file in files:
+        row = rows.get(file.path)
+
+        if row is None:
+            continue
+
+        if file.md5 and row['md5']:
+            if file.md5 != row['md5']:
+                to_update.append(file.path)
+
+        elif file.mtime and row['zot_mtime']:
+            if file.mtime != row['zot_mtime']:
+                to_update.append(file.path)
+
+    return ([i for i in to_add if i not in moved_to],
+            [i for i in to_delete if i in deleted],
+            to_move,
+            to_update)
+
+def load_json(file_path, default = None):
+    """
+    Load a json state file
+
+    Args:
+        file_path: path of the file
+        default: value if the file does not exist
+
+    Returns: loaded value, default if it cannot be loaded
+    """
+
+    if not os.path.exists(file_path):
+        return default
+
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+
+    except Exception as ex:
+        print(Fore.RED + f"ERROR - Ignoring {file_path}: {ex}" +
+              Style.RESET_ALL)
+        return default
+
+def save_json(file_path, value):
+    """
+    Atomically save a json state file
+
+    Args:
+        file_path: path of the file
+        value: value to save
+
+    Returns: True is success, False otherwise
+    """
+
+    try:
+        with open(f"{file_path}.tmp", 'w') as f:
+            json.dump(value, f)
+
+        os.replace(f"{file_path}.tmp", file_path)
+
+    except Exception as ex:
+        print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+        return False
+
+    return True
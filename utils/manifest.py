@@ -0,0 +1,351 @@
+import os
+import sqlite3
+import threading
+
+# Identity fields that can be used to look up files
+FIELDS = ('zot_key', 'rm_id', 'md5')
+
+# Value of the columns that are not given
+DEFAULTS = {'zot_key': None, 'rm_id': None, 'md5': None, 'size': None,
+            'zot_version': None, 'rm_version': None, 'zot_mtime': None}
+
+class Manifest():
+
+    def __init__(self, file_path):
+        """
+
+        Open (or create) the sync manifest, a SQLite
+        database with one row for every synced file
+
+        Args:
+            file_path: path of the SQLite database
+
+        """
+
+        self.file_path = file_path
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        self.db = sqlite3.connect(file_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                                   path TEXT PRIMARY KEY,
+                                   zot_key TEXT,
+                                   rm_id TEXT,
+                                   md5 TEXT,
+                                   size INTEGER,
+                                   zot_version INTEGER,
+                                   rm_version INTEGER,
+                                   zot_mtime INTEGER)""")
+
+            for field in FIELDS:
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS files_{field} " +
+                                f"ON files ({field})")
+
+            # Journal of the operations of the current sync,
+            # kept until the sync is complete
+            self.db.execute("""CREATE TABLE IF NOT EXISTS plan (
+                                   side TEXT,
+                                   op TEXT,
+                                   path TEXT,
+                                   source TEXT,
+                                   pulled INTEGER DEFAULT 0,
+                                   pushed INTEGER DEFAULT 0,
+                                   PRIMARY KEY (side, op, path))""")
+
+            # Stat metadata of the local directory, to scan
+            # again only the directories that changed
+            self.db.execute("""CREATE TABLE IF NOT EXISTS local_dirs (
+                                   path TEXT PRIMARY KEY,
+                                   mtime_ns INTEGER)""")
+
+            self.db.execute("""CREATE TABLE IF NOT EXISTS local_files (
+                                   path TEXT PRIMARY KEY,
+                                   size INTEGER,
+                                   mtime_ns INTEGER,
+                                   inode INTEGER)""")
+
+            # Files that left the scope of the sync, their
+            # copies are left in place and not synced
+            self.db.execute("""CREATE TABLE IF NOT EXISTS unmanaged (
+                                   path TEXT PRIMARY KEY,
+                                   zot_key TEXT,
+                                   rm_id TEXT)""")
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def rows(self):
+        """
+
+        Returns: dict path -> dict with the row of every synced path
+
+        """
+
+        return {r['path']: dict(r) for r in self.db.execute("SELECT * FROM files")}
+
+    def complete(self):
+        """
+
+        Returns: True if every row has a Zotero key and a reMarkable ID
+
+        """
+
+        return self.db.execute("SELECT COUNT(*) FROM files " +
+                               "WHERE zot_key IS NULL OR rm_id IS NULL").fetchone()[0] == 0
+
+    def get(self, path):
+        """
+
+        Args:
+            path: synced path
+
+        Returns: dict with the row of the path, {} if it is not synced
+
+        """
+
+        row = self.db.execute("SELECT * FROM files WHERE path = ?",
+                              (path,)).fetchone()
+
+        return dict(row) if row else {}
+
+    def lookup(self, field, value):
+        """
+
+        Find the synced paths of a file by identity
+
+        Args:
+            field: 'zot_key', 'rm_id' or 'md5'
+            value: value of the field
+
+        Returns: list of paths
+
+        """
+
+        if field not in FIELDS:
+            raise ValueError(f"Unknown manifest field {field}")
+
+        return [r['path'] for r in self.db.execute(
+            f"SELECT path FROM files WHERE {field} = ? ORDER BY path", (value,))]
+
+    def put(self, path, **fields):
+        """
+
+        Insert or update the row of a path.
+        Fields that are not given are kept.
+
+        Args:
+            path: synced path
+            fields: zot_key, rm_id, md5, size, zot_version,
+                    rm_version, zot_mtime
+
+        """
+
+        row = self.get(path)
+        row.update(fields)
+        row['path'] = path
+
+        with self.lock, self.db:
+            self.db.execute("""INSERT OR REPLACE INTO files
+                                   (path, zot_key, rm_id, md5, size,
+                                    zot_version, rm_version, zot_mtime)
+                               VALUES (:path, :zot_key, :rm_id, :md5, :size,
+                                       :zot_version, :rm_version, :zot_mtime)""",
+                            {**DEFAULTS, **row})
+
+    def delete(self, path):
+        """
+
+        Remove the row of a path
+
+        Args:
+            path: synced path
+
+        """
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def move(self, old, new):
+        """
+
+        Move the row of a path to a new path
+
+        Args:
+            old: synced path
+            new: new path
+
+        """
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE path = ?", (new,))
+            self.db.execute("UPDATE files SET path = ? WHERE path = ?",
+                            (new, old))
+
+    def unmanage(self, path):
+        """
+
+        Stop syncing a path, its row is removed and
+        its identity kept in the unmanaged files
+
+        Args:
+            path: synced path
+
+        """
+
+        with self.lock, self.db:
+            self.db.execute("""INSERT OR REPLACE INTO unmanaged (path, zot_key, rm_id)
+                               SELECT path, zot_key, rm_id FROM files WHERE path = ?""",
+                            (path,))
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def unmanaged(self):
+        """
+
+        Returns: list of dicts with the path, the Zotero key
+                 and the reMarkable ID of the unmanaged files
+
+        """
+
+        return [dict(r) for r in self.db.execute("SELECT * FROM unmanaged")]
+
+    def readmit(self, paths):
+        """
+
+        Sync again unmanaged paths
+
+        Args:
+            paths: unmanaged paths
+
+        """
+
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM unmanaged WHERE path = ?",
+                                [(i,) for i in paths])
+
+    def replace(self, rows):
+        """
+
+        Replace all the rows in a single transaction
+
+        Args:
+            rows: list of dicts with the columns of each row
+
+        """
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.executemany("""INSERT INTO files
+                                       (path, zot_key, rm_id, md5, size,
+                                        zot_version, rm_version, zot_mtime)
+                                   VALUES (:path, :zot_key, :rm_id, :md5, :size,
+                                           :zot_version, :rm_version, :zot_mtime)""",
+                                [{**DEFAULTS, **r} for r in rows])
+
+    def save_plan(self, ops):
+        """
+
+        Persist the plan of a sync before it is executed,
+        replacing the previous one in a single transaction
+
+        Args:
+            ops: list of dicts with the side ('zot' or 'rm'),
+                 the op ('add', 'delete', 'move' or 'update'),
+                 the path and the source path of the moves
+
+        """
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM plan")
+            self.db.executemany("""INSERT OR REPLACE INTO plan (side, op, path, source)
+                                   VALUES (:side, :op, :path, :source)""",
+                                [{'source': None, **i} for i in ops])
+
+    def load_plan(self):
+        """
+
+        Returns: list of dicts with the operations of
+                 the plan that have not been pushed yet
+
+        """
+
+        return [dict(r) for r in self.db.execute(
+            "SELECT * FROM plan WHERE pushed = 0 ORDER BY rowid")]
+
+    def done(self, side, op, path, stage):
+        """
+
+        Commit a completed operation of the plan
+
+        Args:
+            side: 'zot' or 'rm'
+            op: 'add', 'delete', 'move' or 'update'
+            path: path of the operation
+            stage: 'pulled' or 'pushed'
+
+        """
+
+        if stage not in ('pulled', 'pushed'):
+            raise ValueError(f"Unknown plan stage {stage}")
+
+        with self.lock, self.db:
+            self.db.execute(f"UPDATE plan SET {stage} = 1 " +
+                            "WHERE side = ? AND op = ? AND path = ?",
+                            (side, op, path))
+
+    def clear_plan(self):
+        """
+
+        Remove the plan once the sync is complete
+
+        """
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM plan")
+
+    def local(self):
+        """
+
+        Returns: dict path -> mtime_ns of the scanned directories,
+                 None if it has to be scanned again, and dict
+                 path -> (size, mtime_ns, inode) of their files
+
+        """
+
+        dirs = {r['path']: r['mtime_ns'] for r in self.db.execute(
+            "SELECT * FROM local_dirs")}
+        files = {r['path']: (r['size'], r['mtime_ns'], r['inode']) for r in self.db.execute(
+            "SELECT * FROM local_files")}
+
+        return dirs, files
+
+    def update_local(self, dirs, files, removed_dirs, removed_files):
+        """
+
+        Save the changes of a scan of the local
+        directory in a single transaction
+
+        Args:
+            dirs: dict path -> mtime_ns of the scanned directories
+            files: dict path -> (size, mtime_ns, inode) of the
+                   new and changed files
+            removed_dirs: paths of the directories removed
+            removed_files: paths of the files removed
+
+        """
+
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM local_dirs WHERE path = ?",
+                                [(i,) for i in removed_dirs])
+            self.db.executemany("DELETE FROM local_files WHERE path = ?",
+                                [(i,) for i in removed_files])
+            self.db.executemany("INSERT OR REPLACE INTO local_dirs VALUES (?, ?)",
+                                list(dirs.items()))
+            self.db.executemany("INSERT OR REPLACE INTO local_files VALUES (?, ?, ?, ?)",
+                                [(k, *v) for k, v in files.items()])
+
+    def close(self):
+        self.db.close()
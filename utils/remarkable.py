@@ -1,15 +1,47 @@
 import os
 import sys
+import json
+import time
+import base64
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from colorama import Fore, Style
-from rmapy.api import Client
-from rmapy.exceptions import AuthError
-from rmapy.folder import Folder
-from rmapy.document import ZipDocument
+from rmapy.exceptions import AuthError, ApiError
+from requests.exceptions import RequestException
 from utils.common import File
+from utils.report import report
+from utils.budget import Budget
+
+# The saved user token is renewed when it
+# expires in less than this many seconds
+TOKEN_MARGIN = 600
+
+def token_expiry(token):
+    """
+
+    Expiry time of a user token, read from the
+    claims of the JWT without verifying it
+
+    Args:
+        token: user token
+
+    Returns: timestamp, None if it cannot be read
+
+    """
+
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+
+    except Exception:
+        return None
+
 
 class ReMarkable():
 
-    def __init__(self, local_dir, reMarkable_dir):
+    def __init__(self, local_dir, reMarkable_dir, workers = 4):
         """
 
         Initialize the rmapy instance
@@ -17,42 +49,302 @@ class ReMarkable():
         Args:
             local_dir: local directory
             reMarkable_dir: reMarkable directory
+            workers: number of concurrent uploads
 
         """
 
         self.files = []
         self.dir_l = local_dir
         self.dir_rm = reMarkable_dir
+        self.workers = workers
+
+        # Files downloaded for an upload, next to the local directory
+        self.tmp_dir = f"{os.path.normpath(local_dir)}.tmp"
+
+        # The client and the indexes are set up on first
+        # use, no request is made until they are needed
+        self.client = None
+        self.by_id = None
+        self.generation = None
+
+    @property
+    def rm(self):
+        """
+
+        rmapy client, created on first use. The user
+        token saved by rmapy is reused until it expires.
+
+        """
+
+        if self.client is None:
+            from rmapy.api import Client
+
+            self.client = Client()
+
+            if not self.renew_token(force=False):
+                sys.exit(1)
+
+        return self.client
+
+    def renew_token(self, force = True):
+        """
+
+        Renew the user token of the rmapy client
+
+        Args:
+            force: renew it even if the saved one
+                   does not expire soon
+
+        Returns: True is success, False otherwise
+
+        """
 
         try:
-            self.rm = Client()
+            expiry = token_expiry(self.rm.token_set["usertoken"])
 
-            self.rm.renew_token()
+            if force or expiry is None or expiry - time.time() < TOKEN_MARGIN:
+                self.rm.renew_token()
 
             if not self.rm.is_auth():
                 print(Fore.RED + 'ERROR - reMarkable ' +
                       'API not authorized... Please ' +
                       'run authorize_rmapy.py' +
                       Style.RESET_ALL)
-                sys.exit(1)
+                return False
 
         except AuthError as ex:
             print(Fore.RED + f'ERROR - {ex} ' +
                   'Please run authorize_rmapy.py' +
                   Style.RESET_ALL)
-            sys.exit(1)
+            return False
+
+        # Network errors, the token is renewed again later
+        except RequestException as ex:
+            print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+            return False
+
+        return True
+
+    def root(self):
+        """
+
+        Find the <dir_rm> folder, creating it in the
+        reMarkable root directory if it does not exist
+
+        Returns: list of the folders named <dir_rm>
+
+        """
 
-        folder = [ i for i in self.rm.get_meta_items()
-            if ((i.VissibleName == self.dir_rm) & (i.Parent == "")) ]
+        folder = self.lookup("", self.dir_rm, "CollectionType")
 
         if len(folder) == 0:
+            from rmapy.folder import Folder
+
             new_folder = Folder(VissibleName=self.dir_rm, Parent="")
 
             if not self.rm.create_folder(new_folder):
                 print(Fore.RED +
                       f"\t ERROR - Cannot create folder {self.dir_rm} in reMarkable root directory" +
                       Style.RESET_ALL)
-                sys.exit(1)
+                return []
+
+            self.index(new_folder)
+            folder = [new_folder]
+
+        return folder
+
+    def snapshot(self):
+        """
+
+        Take a snapshot of the reMarkable metadata
+        and build the in-memory indexes:
+            by_id: ID -> item
+            by_name: (Parent, VissibleName) -> [items]
+            children: Parent -> [items]
+
+        This is the only place where the full
+        document listing is requested.
+
+        """
+
+        items = self.rm.get_meta_items()
+
+        # The indexes are updated in place, they can be
+        # shared with the instances of other directories
+        if self.by_id is None:
+            self.by_id = {}
+            self.by_name = {}
+            self.children = {}
+            self.folders = {}
+
+        for index in (self.by_id, self.by_name, self.children, self.folders):
+            index.clear()
+
+        for i in items:
+            self.index(i)
+
+        self.checkpoint()
+
+    def checkpoint(self):
+        """
+
+        Take the indexes as the listing last seen. After
+        a sync they have the changes it made, which are
+        not reported as changes by the next snapshot.
+
+        """
+
+        # The API has no change counter, the generation
+        # of the listing is given by the item versions
+        self.generation = hash(frozenset((i.ID, i.Version, i.Parent, i.VissibleName)
+                                         for i in self.by_id.values()))
+
+    def target(self, local_dir, reMarkable_dir, workers = None):
+        """
+
+        ReMarkable instance for another directory, sharing
+        the client and the metadata snapshot of this one,
+        so the token and the listing are requested once
+
+        Args:
+            local_dir: local directory
+            reMarkable_dir: reMarkable directory
+            workers: number of concurrent uploads, the
+                     ones of this instance if None
+
+        Returns: ReMarkable instance
+
+        """
+
+        if self.by_id is None:
+            self.snapshot()
+
+        other = ReMarkable(local_dir, reMarkable_dir, workers or self.workers)
+
+        for name in ('client', 'by_id', 'by_name', 'children', 'folders', 'generation'):
+            setattr(other, name, getattr(self, name))
+
+        return other
+
+    def changed(self):
+        """
+
+        Take a new metadata snapshot and check if its
+        generation changed. The snapshot is reused by
+        the next fetch.
+
+        Returns: True if it changed
+
+        """
+
+        generation = self.generation
+        self.snapshot()
+
+        return self.generation != generation
+
+
+    def index(self, item):
+        """
+
+        Add an item to the in-memory indexes
+
+        Args:
+            item: rmapy meta item
+
+        """
+
+        self.by_id[item.ID] = item
+        self.by_name.setdefault((item.Parent, item.VissibleName), []).append(item)
+        self.children.setdefault(item.Parent, []).append(item)
+
+
+    def unindex(self, item):
+        """
+
+        Remove an item from the in-memory indexes
+
+        Args:
+            item: rmapy meta item
+
+        """
+
+        self.by_id.pop(item.ID, None)
+
+        for index, key in ((self.by_name, (item.Parent, item.VissibleName)),
+                           (self.children, item.Parent)):
+            items = [i for i in index.get(key, []) if i.ID != item.ID]
+            if items:
+                index[key] = items
+            else:
+                index.pop(key, None)
+
+
+    def lookup(self, parent, name, item_type = None):
+        """
+
+        Find the items called name in the parent folder
+
+        Args:
+            parent: parent folder ID ("" for root)
+            name: reMarkable VissibleName
+            item_type: "CollectionType", "DocumentType" or None for both
+
+        Returns: list of matching rmapy meta items
+
+        """
+
+        return [ i for i in self.by_name.get((parent, name), [])
+                 if item_type is None or i.Type == item_type ]
+
+
+    def folder_id(self, path):
+        """
+
+        Resolve a reMarkable folder path to its ID,
+        creating the missing folders on the way.
+
+        Resolved paths are cached in self.folders
+        until the next snapshot.
+
+        Args:
+            path: folder path from the reMarkable root
+
+        Returns: folder ID, None if a folder cannot be created
+
+        """
+
+        if path in self.folders:
+            return self.folders[path]
+
+        parent = ""
+        if os.path.dirname(path):
+            parent = self.folder_id(os.path.dirname(path))
+            if parent is None:
+                return None
+
+        name = os.path.basename(path)
+        folder = self.lookup(parent, name, "CollectionType")
+
+        if len(folder) == 0:
+            from rmapy.folder import Folder
+
+            new_folder = Folder(VissibleName=name, Parent=parent)
+
+            try:
+                if not self.rm.create_folder(new_folder):
+                    raise Exception("folder not created")
+
+            except Exception as ex:
+                print(Fore.RED +
+                      f"\t ERROR - Cannot create folder {name} of path {path}: {ex}" +
+                      Style.RESET_ALL)
+                return None
+
+            self.index(new_folder)
+            folder = [new_folder]
+
+        self.folders[path] = folder[0].ID
+        return folder[0].ID
 
 
     def recursive_fetch(self, item, path = ''):
@@ -67,7 +359,7 @@ class ReMarkable():
 
         """
 
-        for i in self.rm.get_meta_items().children(item):
+        for i in self.children.get(item.ID, []):
             if i.Type == "CollectionType":
                 parent = os.path.join(path, i.VissibleName)
                 self.recursive_fetch(i, parent)
@@ -75,23 +367,30 @@ class ReMarkable():
             elif i.Type == "DocumentType":
                 file_path = os.path.join(path,
                             f'{i.VissibleName}.pdf')
-                self.files.append(File(file_path, i.ID))
+                self.files.append(File(file_path, i.ID, version=i.Version))
 
 
-    def fetch(self):
+    def fetch(self, refresh = False):
         """
 
         Fetch all the .pdf file stored in directory self.dir_rm.
 
+        Args:
+            refresh: take a new metadata snapshot instead
+                     of reusing the one of this run, the
+                     first fetch always takes one
+
         Returns: True is success, False otherwise
 
         """
 
         self.files = []
 
+        if refresh or self.by_id is None:
+            self.snapshot()
+
         # Find the <dir_rm> folder
-        folder = [ i for i in self.rm.get_meta_items()
-                   if i.VissibleName == self.dir_rm ]
+        folder = self.root()
 
         if len(folder) == 1:
             self.recursive_fetch(folder[0])
@@ -113,7 +412,7 @@ class ReMarkable():
         return True
 
 
-    def pull(self, to_add, to_delete, verbose = False):
+    def pull(self, to_add, to_delete, commit = None, verbose = False):
         """
 
         Pull from reMarkable the files to
@@ -128,6 +427,8 @@ class ReMarkable():
         Args:
             to_add: list of files to add
             to_delete: list of files to delete
+            commit: function called with the op and the path
+                    of every completed operation
             verbose: enable print information
 
         Returns: True is success, False otherwise
@@ -137,6 +438,8 @@ class ReMarkable():
         if verbose:
             print("reMarkable - Pull information")
 
+        commit = commit or (lambda op, path: None)
+
         # TODO: Pull new files from reMarkable
         # files_to_add = [i for i in self.files if i.path in to_add]
         # for file in files_to_add:
@@ -150,7 +453,11 @@ class ReMarkable():
             file_path = os.path.join(self.dir_l, file)
 
             try:
-                os.remove(file_path)
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+                commit('delete', file)
+
                 if verbose:
                     print(Fore.RED +
                           f"\t Deleted: {file_path}" +
@@ -162,15 +469,172 @@ class ReMarkable():
 
         return True
 
-    def push(self, to_add, to_delete, verbose = False):
+    def find(self, file):
         """
 
-        Push to reMarkable the files to add
-        and the files to delete
+        Find the document of a file in the
+        indexes, without creating any folder
 
         Args:
-            to_add: list of files to add
+            file: path of the file in self.dir_rm
+
+        Returns: rmapy Document, None if it does not exist
+
+        """
+
+        parent = ""
+        path = os.path.join(self.dir_rm, file)
+
+        for p in os.path.dirname(path).split("/"):
+            folder = self.lookup(parent, p, "CollectionType")
+            if len(folder) == 0:
+                return None
+            parent = folder[0].ID
+
+        document = self.lookup(parent, os.path.basename(file)[:-4], "DocumentType")
+
+        return document[0] if document else None
+
+    def move(self, doc, file):
+        """
+
+        Move and rename a document updating only its metadata
+
+        Args:
+            doc: rmapy Document
+            file: new path of the file in self.dir_rm
+
+        """
+
+        from rmapy.document import Document
+
+        moved = Document(**doc.to_dict())
+        moved.Parent = self.folder_id(os.path.dirname(os.path.join(self.dir_rm, file)))
+        moved.VissibleName = os.path.basename(file)[:-4]
+
+        if moved.Parent is None:
+            raise Exception(f"Cannot create the folder of {file}")
+
+        self.rm.update_metadata(moved)
+        moved.Version = doc.Version + 1
+
+        self.unindex(doc)
+        self.index(moved)
+
+    def upload(self, file, parent, source = None, budget = None):
+        """
+
+        Package a .pdf file and upload it to reMarkable.
+
+        Without a source the file is read from the local
+        directory. Otherwise source(file, path) downloads it
+        to a temporary path, removed after the upload.
+
+        Args:
+            file: path of the file in the local directory
+            parent: ID of the reMarkable folder
+            source: function to download the file
+            budget: Budget of the run spending the uploaded bytes
+
+        Returns: rmapy Document of the uploaded file
+
+        """
+
+        from rmapy.document import Document, ZipDocument
+
+        if source is None:
+            file_path = os.path.join(self.dir_l, file)
+            tmp_dir = None
+
+        else:
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+            file_path = os.path.join(tmp_dir, os.path.basename(file))
+            source(file, file_path)
+
+        try:
+            start = time.perf_counter()
+            rawDocument = ZipDocument(doc=file_path)
+            self.rm.upload(rawDocument, self.by_id[parent])
+            size = os.path.getsize(file_path)
+
+            report.transfer('remarkable', 'upload', file,
+                            time.perf_counter() - start, size)
+
+            if budget is not None:
+                budget.spend(size)
+
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return Document(ID=rawDocument.ID,
+                        VissibleName=rawDocument.metadata["VissibleName"],
+                        Parent=parent,
+                        Version=1)
+
+    def delete(self, docs):
+        """
+
+        Delete documents with a single status update,
+        removing the deleted ones from the indexes
+
+        Args:
+            docs: list of rmapy Documents
+
+        Returns: dict ID -> error message of the
+                 documents that were not deleted
+
+        """
+
+        if len(docs) == 0:
+            return {}
+
+        response = self.rm.request("PUT", "/document-storage/json/2/delete",
+                                   body=[{"ID": i.ID, "Version": i.Version}
+                                         for i in docs])
+
+        if not response.ok:
+            raise ApiError(f"Got An invalid HTTP Response: {response.status_code}",
+                           response=response)
+
+        results = {i.get("ID"): i for i in response.json()}
+        failed = {}
+
+        for doc in docs:
+            result = results.get(doc.ID, {})
+
+            if result.get("Success"):
+                self.unindex(doc)
+            else:
+                failed[doc.ID] = result.get("Message", "No response")
+
+        return failed
+
+    def push(self, transfers, to_delete, to_move = (),
+             rm_ids = None, source = None, commit = None, budget = None,
+             verbose = False):
+        """
+
+        Push to reMarkable the files to add, the files
+        to move, the modified files and the files to delete
+
+        Args:
+            transfers: list of (op, path) of the files to add
+                       ('add') and of the modified files to
+                       upload again ('update')
             to_delete: list of files to delete
+            to_move: list of (old, new) files to move
+            rm_ids: dict file -> reMarkable ID of its synced
+                    document, the old file for the moves
+            source: function to download the files to add,
+                    None to read them from the local directory
+            commit: function called with the op and the path
+                    of every completed operation
+            budget: Budget of the run spending the uploaded
+                    bytes. Files downloaded by source are
+                    transferred in the order of transfers until
+                    it is exhausted, local files are all uploaded.
             verbose: enable print information
 
         Returns: True is success, False otherwise
@@ -180,67 +644,172 @@ class ReMarkable():
         if verbose:
             print("reMarkable - Push information")
 
-        for file in to_add:
-            file_path_l = os.path.join(self.dir_l, file)
-            file_path_rm = os.path.join(self.dir_rm, file)
-            parent = ""
-            folder = ""
+        commit = commit or (lambda op, path: None)
+        budget = budget or Budget()
+        files = []
+        updates = {path for op, path in transfers if op == 'update'}
+        moved = set()
+        ids = {i.path: i.id for i in self.files}
+        ids.update({k: v for k, v in (rm_ids or {}).items() if v})
+
+        # Moves and renames only update the metadata, the
+        # document and its annotations are kept. If the
+        # document is gone, the file is uploaded again.
+        for old, new in to_move:
+            id = ids.get(old)
+
+            if id not in self.by_id:
+                files.append(new)
+                moved.add(new)
+                continue
 
-            # Create the directory in reMarkable
-            # if it does not exist
-            for p in os.path.dirname(file_path_rm).split("/"):
-                folder = [ i for i in self.rm.get_meta_items()
-                    if ((i.VissibleName == p) & (i.Parent == parent)) ]
+            try:
+                self.move(self.by_id[id], new)
+                commit('move', new)
 
-                if len(folder) == 0:
-                    new_folder = Folder(VissibleName=p, Parent=parent)
+                if verbose:
+                    print(Fore.GREEN +
+                          f"\t Moved: {os.path.join(self.dir_rm, old)} -> " +
+                          f"{os.path.join(self.dir_rm, new)}" +
+                          Style.RESET_ALL)
 
-                    if not self.rm.create_folder(new_folder):
-                        print(Fore.RED +
-                              f"\t ERROR - Cannot create folder {p} of path {os.path.dirname(file_path_rm)}" +
-                              Style.RESET_ALL)
-                        return False
+            except Exception as ex:
+                print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+                return False
 
-                    folder = [ i for i in self.rm.get_meta_items()
-                             if ((i.VissibleName == p) & (i.Parent == parent)) ]
-                parent = folder[0].ID
+        files += [path for op, path in transfers]
+
+        # Left for the next run, the local files were
+        # pulled within the budget of the run
+        def exhausted():
+            return source is not None and budget.exhausted
+
+        if exhausted():
+            files = []
+
+        # Create the missing directories once each,
+        # parents before children
+        for path in sorted({os.path.dirname(os.path.join(self.dir_rm, i))
+                            for i in files}):
+            if self.folder_id(path) is None:
+                return False
 
-            # Upload the file to reMarkable
-            # if it does not exist
-            if (len([ i for i in self.rm.get_meta_items().children(folder[0])
-                if ((i.Type == "DocumentType") & (i.VissibleName == file[:-4]))]) == 0):
+        # Package and upload the files that do not exist
+        # yet, a worker zips a file while others upload.
+        # Modified files replace their synced document
+        # once the new one is uploaded.
+        errors = []
+        updated = {}
+
+        def synced(file):
+            # Documents without a known ID, synced by
+            # previous versions, are found by name
+            id = (rm_ids or {}).get(file)
+            return self.by_id.get(id) if id else self.find(file)
+
+        def send(file, parent):
+            # Left for the next run
+            if exhausted():
+                return None
+
+            return self.upload(file, parent, source, budget)
+
+        # The pool starts the uploads in the given order
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {}
+
+            for file in files:
+                parent = self.folder_id(os.path.dirname(os.path.join(self.dir_rm, file)))
+                name = os.path.basename(file)[:-4]
+                replaced = synced(file) if file in updates else None
+                others = [i for i in self.lookup(parent, name, "DocumentType")
+                          if replaced is None or i.ID != replaced.ID]
+
+                if len(others) == 0:
+                    future = pool.submit(send, file, parent)
+                    futures[future] = (file, replaced)
+
+                # Uploaded by an interrupted sync, the
+                # synced document is still replaced
+                elif file in updates:
+                    updated[file] = replaced
+
+                # Uploaded by an interrupted sync
+                else:
+                    try:
+                        commit('move' if file in moved else 'add', file)
+
+                    except Exception as ex:
+                        errors.append((os.path.join(self.dir_rm, file), ex))
+
+            for future in as_completed(futures):
+                file, replaced = futures[future]
+                file_path_rm = os.path.join(self.dir_rm, file)
 
                 try:
-                    rawDocument = ZipDocument(doc=file_path_l)
-                    self.rm.upload(rawDocument, folder[0])
+                    if future.result() is None:
+                        continue
+
+                    self.index(future.result())
+
+                    if file in updates:
+                        updated[file] = replaced
+                    else:
+                        commit('move' if file in moved else 'add', file)
 
                     if verbose:
                         print(Fore.GREEN +
-                              f"\t New: {file_path_rm}" +
+                              f"\t {'Updated' if replaced else 'New'}: {file_path_rm}" +
                               Style.RESET_ALL)
 
                 except Exception as ex:
-                    print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
-                    return False
+                    errors.append((file_path_rm, ex))
+
+        for file_path_rm, ex in errors:
+            print(Fore.RED + f"ERROR - {file_path_rm}: {ex}" + Style.RESET_ALL)
+
+        if errors:
+            print(Fore.RED +
+                  f"ERROR - {len(errors)} of {len(futures)} uploads failed" +
+                  Style.RESET_ALL)
+
+        # The documents to delete are resolved from the
+        # fetched metadata and deleted, together with the
+        # documents replaced by the completed uploads, in
+        # a single request
+        files = {i.path: i for i in self.files}
+        files_to_delete = [files[i] for i in to_delete
+                           if i in files and files[i].id in self.by_id]
 
+        try:
+            failed = self.delete([i for i in updated.values() if i] +
+                                 [self.by_id[i.id] for i in files_to_delete])
+
+        except Exception as ex:
+            print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+            return False
+
+        for id, message in failed.items():
+            print(Fore.RED + f"ERROR - Cannot delete {id}: {message}" + Style.RESET_ALL)
+
+        # Modified files are committed once their
+        # previous document is deleted
+        for file, replaced in updated.items():
+            if replaced is None or replaced.ID not in failed:
+                commit('update', file)
 
-        files_to_delete = [i for i in self.files if i.path in to_delete]
         for file in files_to_delete:
-            file_path = os.path.join(self.dir_rm, file.path)
-            try:
-                doc = self.rm.get_doc(file.id)
-                self.rm.delete(doc)
+            if file.id not in failed:
+                commit('delete', file.path)
 
-                if verbose:
+        if verbose:
+            for file in files_to_delete:
+                if file.id not in failed:
                     print(Fore.RED +
-                          f"\t Deleted: {file_path}" +
+                          f"\t Deleted: {os.path.join(self.dir_rm, file.path)}" +
                           Style.RESET_ALL)
 
-            except Exception as ex:
-                print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
-                return False
-
-        return True
+        return len(errors) == 0 and len(failed) == 0
 
 def authorize(security_code):
     """
@@ -254,6 +823,8 @@ def authorize(security_code):
 
     """
 
+    from rmapy.api import Client
+
     rm = Client()
 
     try:
@@ -0,0 +1,414 @@
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Modules whose requests are counted for each backend
+BACKENDS = {'zotero': ('pyzotero', 'utils.zotero'),
+            'remarkable': ('rmapy', 'utils.remarkable')}
+
+class Report():
+
+    def __init__(self):
+        """
+
+        Instrumentation of a run: wall-clock time of every
+        phase, HTTP requests and bytes of every backend,
+        and duration of every file transfer
+
+        """
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.installed = False
+        self.reset()
+
+    def reset(self):
+        """
+
+        Start a new report
+
+        """
+
+        with self.lock:
+            self.started = time.time()
+            self.phases = {}
+            self.requests = {}
+            self.transfers = []
+            self.changes = {}
+            self.targets = {}
+
+    @contextmanager
+    def target(self, name):
+        """
+
+        Record the phases and the changes of the code run
+        by this thread as the ones of a target of the run
+
+        Args:
+            name: name of the target, None for the whole run
+
+        """
+
+        previous = self.current()
+        self.local.target = name
+
+        try:
+            yield
+
+        finally:
+            self.local.target = previous
+
+    def current(self):
+        """
+
+        Returns: name of the target of this thread, None if none
+
+        """
+
+        return getattr(self.local, 'target', None)
+
+    def bind(self, function):
+        """
+
+        Args:
+            function: function to run in another thread
+
+        Returns: function running as the target of this thread
+
+        """
+
+        name = self.current()
+
+        def bound(*args, **kwargs):
+            with self.target(name):
+                return function(*args, **kwargs)
+
+        return bound
+
+    def section(self):
+        """
+
+        Returns: dict with the phases and the changes
+                 of the target of this thread
+
+        """
+
+        name = self.current()
+
+        if name is None:
+            return {'phases': self.phases, 'changes': self.changes}
+
+        return self.targets.setdefault(name, {'phases': {}, 'changes': {}})
+
+    def changed(self, **changes):
+        """
+
+        Record the changes synced
+
+        Args:
+            changes: number of files of every change, like new=3
+
+        """
+
+        with self.lock:
+            section = self.section()
+            section['changes'].clear()
+            section['changes'].update(changes)
+
+    @contextmanager
+    def phase(self, name):
+        """
+
+        Time a phase of the run, the times of
+        a phase run more than once are added
+
+        Args:
+            name: name of the phase
+
+        """
+
+        start = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            elapsed = time.perf_counter() - start
+
+            with self.lock:
+                phases = self.section()['phases']
+                phases[name] = phases.get(name, 0) + elapsed
+
+    def timed(self, name, function, *args, **kwargs):
+        """
+
+        Call a function timing it as a phase
+
+        Args:
+            name: name of the phase
+            function: function to call
+            args, kwargs: arguments of the function
+
+        Returns: result of the function
+
+        """
+
+        with self.phase(name):
+            return function(*args, **kwargs)
+
+    def request(self, backend, sent, received):
+        """
+
+        Count an HTTP request
+
+        Args:
+            backend: 'zotero', 'remarkable' or 'other'
+            sent: bytes of the request body
+            received: bytes of the response body
+
+        """
+
+        with self.lock:
+            counters = self.counters(backend)
+            counters['requests'] += 1
+            counters['bytes_sent'] += sent
+            counters['bytes_received'] += received
+
+    def retry(self, backend):
+        """
+
+        Count a request sent again
+
+        Args:
+            backend: 'zotero', 'remarkable' or 'other'
+
+        """
+
+        with self.lock:
+            self.counters(backend)['retries'] += 1
+
+    def counters(self, backend):
+        """
+
+        Args:
+            backend: 'zotero', 'remarkable' or 'other'
+
+        Returns: dict with the counters of the backend
+
+        """
+
+        return self.requests.setdefault(backend, {'requests': 0,
+                                                  'retries': 0,
+                                                  'bytes_sent': 0,
+                                                  'bytes_received': 0})
+
+    def transfer(self, backend, op, path, seconds, size):
+        """
+
+        Record the transfer of a file
+
+        Args:
+            backend: 'zotero' or 'remarkable'
+            op: 'download' or 'upload'
+            path: path of the file
+            seconds: duration of the transfer
+            size: bytes of the file
+
+        """
+
+        with self.lock:
+            self.transfers.append({'backend': backend, 'op': op, 'path': path,
+                                   'seconds': round(seconds, 6), 'bytes': size})
+
+    def install(self):
+        """
+
+        Count the requests sent with requests, the HTTP
+        library of pyzotero and rmapy. The backend of a
+        request is the module that sent it.
+
+        """
+
+        if self.installed:
+            return
+
+        import requests
+
+        send = requests.Session.send
+        report = self
+
+        def counted_send(session, request, **kwargs):
+            response = send(session, request, **kwargs)
+
+            body = request.body or b''
+            sent = len(body.encode() if isinstance(body, str) else body) \
+                if isinstance(body, (str, bytes)) else 0
+
+            if kwargs.get('stream'):
+                received = int(response.headers.get('Content-Length') or 0)
+            else:
+                received = len(response.content or b'')
+
+            report.request(backend(), sent, received)
+
+            return response
+
+        requests.Session.send = counted_send
+        self.installed = True
+
+    def to_dict(self, success = None):
+        """
+
+        Args:
+            success: result of the run
+
+        Returns: dict with the report, with the phases and the
+                 changes of every target of a run with several
+
+        """
+
+        with self.lock:
+            result = {'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                      'duration': round(time.time() - self.started, 6),
+                      'success': success,
+                      'phases': {k: round(v, 6) for k, v in self.phases.items()},
+                      'requests': {k: dict(v) for k, v in self.requests.items()},
+                      'changes': dict(self.changes),
+                      'transfers': list(self.transfers)}
+
+            if self.targets:
+                result['targets'] = {name: {'phases': {k: round(v, 6)
+                                                       for k, v in i['phases'].items()},
+                                            'changes': dict(i['changes'])}
+                                     for name, i in self.targets.items()}
+
+            return result
+
+    def dump(self, file = None, success = None):
+        """
+
+        Write the report as JSON
+
+        Args:
+            file: path of the file, None for stdout
+            success: result of the run
+
+        """
+
+        text = json.dumps(self.to_dict(success), indent=2)
+
+        if file is None:
+            print(text)
+        else:
+            with open(file, 'w') as f:
+                f.write(text + '\n')
+
+
+class Profiler():
+
+    def __init__(self):
+        """
+
+        cProfile of the run and of the threads it starts,
+        like the pools of the fetch, of the transfers and
+        of the targets. A cProfile profiler only profiles
+        the thread that enables it, every thread gets its
+        own and their stats are merged.
+
+        """
+
+        self.lock = threading.Lock()
+        self.profilers = []
+        self.run = None
+
+    def enable(self):
+        """
+
+        Profile this thread and the threads started from now
+
+        """
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        self.profilers.append(profiler)
+
+        run = self.run = threading.Thread.run
+        profilers = self
+
+        def profiled_run(thread):
+            profiler = cProfile.Profile()
+
+            try:
+                profiler.enable()
+
+            # Python 3.12 profiles every thread with a single profiler
+            except ValueError:
+                return run(thread)
+
+            with profilers.lock:
+                profilers.profilers.append(profiler)
+
+            try:
+                return run(thread)
+
+            finally:
+                profiler.disable()
+
+        threading.Thread.run = profiled_run
+
+    def disable(self):
+        """
+
+        Stop profiling, the threads that are still
+        running are profiled until they finish
+
+        """
+
+        threading.Thread.run = self.run
+        self.profilers[0].disable()
+
+    def stats(self, stream = None):
+        """
+
+        Args:
+            stream: stream where the stats are printed
+
+        Returns: pstats.Stats of every profiled thread
+
+        """
+
+        with self.lock:
+            return pstats.Stats(*self.profilers, stream=stream)
+
+
+def backend(frame = None):
+    """
+
+    Backend of the code running a request, from the
+    modules of the frames of the call stack
+
+    Returns: 'zotero', 'remarkable' or 'other'
+
+    """
+
+    frame = frame or sys._getframe(1)
+
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+
+        for name, prefixes in BACKENDS.items():
+            if module.startswith(prefixes):
+                return name
+
+        frame = frame.f_back
+
+    return 'other'
+
+
+# Report of the current run
+report = Report()
@@ -0,0 +1,315 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+import requests
+from utils.report import report, backend
+
+# Default requests per second of every backend, the rate
+# is halved every time the server throttles a request and
+# grows back a step for every request it accepts
+RATE = 50
+RATE_STEPS = 20
+
+# Default retries of a failed request
+RETRIES = 5
+
+# Methods safe to send again after an error, RFC 7231
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# Status of the responses that are retried
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Scheduler of every backend, see configure
+SCHEDULERS = {}
+
+# Whether requests.Session.send is patched
+installed = False
+
+# Set while a thread is sending a scheduled request,
+# the requests of its redirects are not scheduled again
+local = threading.local()
+
+class Scheduler():
+
+    def __init__(self, rate = RATE, burst = None, concurrency = 4,
+                 retries = RETRIES, base_delay = 0.5, max_delay = 60):
+        """
+
+        Schedule the requests of a backend: at most rate
+        requests per second with bursts of burst requests
+        (token bucket), at most concurrency requests at the
+        same time, waiting the Backoff and Retry-After of the
+        server and retrying errors with jittered exponential
+        back-off
+
+        Args:
+            rate: highest requests per second, 0 for no limit
+            burst: size of the bucket, 2 * rate by default
+            concurrency: requests sent at the same time
+            retries: retries of a failed request
+            base_delay: seconds before the first retry
+            max_delay: longest wait before a retry
+
+        """
+
+        self.rate = rate
+        self.limit = rate
+        self.burst = burst or max(1, 2 * rate)
+        self.tokens = self.burst
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.updated = time.monotonic()
+        self.until = 0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max(1, concurrency))
+
+    def throttle(self, seconds):
+        """
+
+        Hold every request for some time
+
+        Args:
+            seconds: time to wait from now
+
+        """
+
+        with self.lock:
+            self.until = max(self.until, time.monotonic() + seconds)
+
+    def adapt(self, throttled):
+        """
+
+        Halve the rate when the server throttles a
+        request, raise it back a step when it does not
+
+        Args:
+            throttled: whether the last request was throttled
+
+        """
+
+        if not self.limit:
+            return
+
+        with self.lock:
+            if throttled:
+                self.rate = max(self.limit / 2 ** RATE_STEPS, self.rate / 2)
+                self.tokens = min(self.tokens, 1)
+            else:
+                self.rate = min(self.limit, self.rate + self.limit / RATE_STEPS)
+
+    def acquire(self):
+        """
+
+        Wait until a request can be sent: no back-off
+        is running and the bucket has a token
+
+        """
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.until - now
+
+                if wait <= 0:
+                    if not self.rate:
+                        return
+
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def delay(self, attempt):
+        """
+
+        Args:
+            attempt: number of the failed attempt, from 0
+
+        Returns: seconds before the next attempt, full jitter
+
+        """
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def send(self, send, session, request, **kwargs):
+        """
+
+        Send a request, retrying it while the server asks
+        to wait or, if it is safe to send it again, while
+        it fails
+
+        Args:
+            send: function sending the request
+            session: requests.Session sending the request
+            request: requests.PreparedRequest to send
+            kwargs: arguments of send
+
+        Returns: requests.Response
+
+        """
+
+        name = backend()
+        idempotent = retryable(request)
+
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            self.acquire()
+
+            try:
+                with self.slots:
+                    response = send(session, request, **kwargs)
+
+            except (requests.ConnectionError, requests.Timeout):
+                if last or not idempotent:
+                    raise
+
+                report.retry(name)
+                time.sleep(self.delay(attempt))
+                continue
+
+            wait = hint(response)
+
+            if wait is not None:
+                self.throttle(wait)
+
+            # Throttled requests were not run by the server,
+            # the other errors only if the method is idempotent
+            throttled = response.status_code == 429 or \
+                (response.status_code == 503 and wait is not None)
+
+            self.adapt(throttled)
+
+            if last or response.status_code not in RETRY_STATUS or \
+                    not (throttled or idempotent) or not can_resend(request):
+                return response
+
+            response.close()
+            report.retry(name)
+
+            if wait is None:
+                time.sleep(self.delay(attempt))
+
+
+def retryable(request):
+    """
+
+    Args:
+        request: requests.PreparedRequest
+
+    Returns: True if sending the request twice has the same effect
+             as sending it once. Conditional requests are not, the
+             first one may have changed the version they depend on.
+
+    """
+
+    return request.method in IDEMPOTENT and \
+        'If-Unmodified-Since-Version' not in request.headers and \
+        'If-Match' not in request.headers
+
+
+def can_resend(request):
+    """
+
+    Args:
+        request: requests.PreparedRequest
+
+    Returns: True if the body can be sent again, False if it is a stream
+
+    """
+
+    return request.body is None or isinstance(request.body, (str, bytes))
+
+
+def hint(response):
+    """
+
+    Time the server asks to wait, from the Backoff
+    header of Zotero or the Retry-After header
+
+    Args:
+        response: requests.Response
+
+    Returns: seconds to wait, None if there is no hint
+
+    """
+
+    waits = []
+
+    for header in ('Backoff', 'Retry-After'):
+        value = response.headers.get(header)
+
+        if not value:
+            continue
+
+        try:
+            waits.append(float(value))
+
+        except ValueError:
+            try:
+                waits.append(parsedate_to_datetime(value).timestamp() - time.time())
+
+            except (TypeError, ValueError):
+                continue
+
+    return max(0, *waits) if waits else None
+
+
+def configure(name, **kwargs):
+    """
+
+    Schedule the requests of a backend
+
+    Args:
+        name: 'zotero' or 'remarkable', see utils.report.BACKENDS
+        kwargs: arguments of Scheduler
+
+    Returns: the Scheduler of the backend
+
+    """
+
+    SCHEDULERS[name] = Scheduler(**kwargs)
+    install()
+
+    return SCHEDULERS[name]
+
+
+def install():
+    """
+
+    Send the requests of pyzotero and rmapy, and of the
+    modules using them, through the scheduler of their
+    backend. Both send them with requests.
+
+    """
+
+    global installed
+
+    if installed:
+        return
+
+    send = requests.Session.send
+
+    def scheduled_send(session, request, **kwargs):
+        scheduler = None if getattr(local, 'active', False) else SCHEDULERS.get(backend())
+
+        if scheduler is None:
+            return send(session, request, **kwargs)
+
+        local.active = True
+
+        try:
+            return scheduler.send(send, session, request, **kwargs)
+
+        finally:
+            local.active = False
+
+    requests.Session.send = scheduled_send
+    installed = True
@@ -0,0 +1,159 @@
+import os
+
+class Scope():
+
+    def __init__(self, include_collections = (), exclude_collections = (),
+                 include_tags = (), exclude_tags = (),
+                 include_types = (), exclude_types = ()):
+        """
+
+        Rules selecting the Zotero files to sync. A file is
+        synced if its collection path starts with one of the
+        included paths and none of the excluded ones, and its
+        item has one of the included tags and item types and
+        none of the excluded ones. Rules that are not given
+        select every file. The tags and the type of a child
+        attachment are the ones of its parent item, standalone
+        attachments have their own tags and the type
+        'attachment'.
+
+        Args:
+            include_collections: collection paths, like "Papers/ML"
+            exclude_collections: collection paths
+            include_tags: tags
+            exclude_tags: tags
+            include_types: Zotero item types, like "journalArticle"
+            exclude_types: Zotero item types
+
+        """
+
+        self.include_collections = [prefix(i) for i in include_collections]
+        self.exclude_collections = [prefix(i) for i in exclude_collections]
+        self.include_tags = set(include_tags)
+        self.exclude_tags = set(exclude_tags)
+        self.include_types = set(include_types)
+        self.exclude_types = set(exclude_types)
+
+    @property
+    def items(self):
+        """
+
+        Whether there are tag or item type rules
+
+        """
+
+        return bool(self.include_tags or self.exclude_tags or
+                    self.include_types or self.exclude_types)
+
+    def collection(self, path):
+        """
+
+        Args:
+            path: collection path, like "Papers/ML/"
+
+        Returns: True if the files of the collection can be synced
+
+        """
+
+        path = prefix(path)
+
+        if self.include_collections and \
+                not any(path.startswith(i) for i in self.include_collections):
+            return False
+
+        return not any(path.startswith(i) for i in self.exclude_collections)
+
+    def file(self, path):
+        """
+
+        Args:
+            path: path of a file in the synced directory
+
+        Returns: True if the collection of the file can be synced
+
+        """
+
+        return self.collection(os.path.dirname(path))
+
+    def item(self, tags, item_type):
+        """
+
+        Args:
+            tags: tags of the item
+            item_type: Zotero item type of the item
+
+        Returns: True if the files of the item can be synced
+
+        """
+
+        tags = set(tags)
+
+        if self.include_tags and not tags & self.include_tags:
+            return False
+
+        if tags & self.exclude_tags:
+            return False
+
+        if self.include_types and item_type not in self.include_types:
+            return False
+
+        return item_type not in self.exclude_types
+
+    def params(self):
+        """
+
+        Filters of the Zotero API selecting the items
+        in scope, the ones that can be expressed in a
+        query: one tag parameter for the included tags,
+        one for every excluded tag, and one item type
+
+        Returns: dict with the query parameters
+
+        """
+
+        params = {}
+        tags = []
+
+        if self.include_tags:
+            tags.append(' || '.join(sorted(self.include_tags)))
+
+        tags += [f'-{i}' for i in sorted(self.exclude_tags)]
+
+        if tags:
+            params['tag'] = tags
+
+        if self.include_types - self.exclude_types:
+            params['itemType'] = ' || '.join(sorted(self.include_types - self.exclude_types))
+        elif not self.include_types and len(self.exclude_types) == 1:
+            params['itemType'] = f'-{next(iter(self.exclude_types))}'
+
+        return params
+
+    def state(self):
+        """
+
+        Returns: dict with the rules, saved with the Zotero state
+
+        """
+
+        return {'include_collections': self.include_collections,
+                'exclude_collections': self.exclude_collections,
+                'include_tags': sorted(self.include_tags),
+                'exclude_tags': sorted(self.exclude_tags),
+                'include_types': sorted(self.include_types),
+                'exclude_types': sorted(self.exclude_types)}
+
+
+def prefix(path):
+    """
+
+    Args:
+        path: collection path
+
+    Returns: path without leading and with a trailing /
+
+    """
+
+    path = path.strip('/')
+
+    return f'{path}/' if path else ''
@@ -1,44 +1,135 @@
 import os
-import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from colorama import Fore, Style
-from pyzotero import zotero
 from pyzotero.zotero_errors import UserNotAuthorised
-from utils.common import File
+from utils.common import File, load_json, save_json, timestamp
+from utils.report import report
+from utils.scope import Scope
+from utils.budget import Budget
+
+# Maximum number of results per page of the Zotero API
+PAGE_SIZE = 100
+
+# Maximum number of keys in an itemKey request of the Zotero API
+KEYS_PER_REQUEST = 50
+
+# Size of the chunks written to disk while downloading a file
+CHUNK_SIZE = 1024 * 1024
+
+# Seconds to wait for the server before giving up on a download
+TIMEOUT = 60
 
 class Zotero():
 
-    def __init__(self, dir, zot_library_id, zot_api_key):
+    def __init__(self, dir, zot_library_id, zot_api_key,
+                 fetch_mode = 'library', workers = 4,
+                 library_type = 'user', scope = None):
         """
 
         Initialize the zotero instance
 
         Args:
             dir: local directory
-            zot_library_id: zotero personal library id
+            zot_library_id: zotero personal or group library id
             zot_api_key: zotero API Key
+            fetch_mode: 'library' to list all the attachments at once,
+                        'collections' to list the items of each collection
+            workers: number of concurrent downloads
+            library_type: 'user' or 'group'
+            scope: Scope of the files to sync, all of them if None
 
         """
 
         self.files = []
         self.dir = dir
+        self.fetch_mode = fetch_mode
+        self.workers = workers
+        self.collections = {}
+        self.paths = {}
+
+        # Incremental sync state, saved next to the local directory
+        self.state_file = f"{os.path.normpath(dir)}.zotero.json"
+
+        # md5 and size of the files downloaded in this run
+        self.downloaded = {}
+        self.by_path = {}
+
+        # Downloads in progress, next to the local directory
+        # so they can be renamed into place atomically
+        self.tmp_dir = f"{os.path.normpath(dir)}.tmp"
+
+        # Content-addressed store of the downloaded files,
+        # every local path of a file is a hardlink to its blob
+        self.store_dir = f"{os.path.normpath(dir)}.store"
+
+        # Whether the blobs can be hardlinked, None until checked
+        self.hardlinks = None
+        self.version = None
+        self.attachments = {}
+        self.parents = {}
+
+        # Attachments out of scope, with their paths if known
+        self.scope = scope or Scope()
+        self.excluded = {}
+
+        # Library version of the saved state, if it was
+        # loaded or saved by this instance
+        self.saved = None
+
+        # Library version last seen by changed() or a fetch,
+        # and the version probed by changed() for the next fetch
+        self.seen = None
+        self.probed = None
+
+        # The client is created on first use, the API key
+        # is checked by the first request of the fetch
+        self.library_id = zot_library_id
+        self.library_type = library_type
+        self.api_key = zot_api_key
+        self.client = None
+
+    @property
+    def zot(self):
+        """
 
-        try:
-            self.zot = zotero.Zotero(zot_library_id, 'user', zot_api_key)
-            self.zot.top()
+        pyzotero client, created on first use
 
-        except UserNotAuthorised as ex:
-            print(Fore.RED +
-                  "ERROR - Zotero API error... " +
-                  "Please run ensure the details are correct\n" +
-                  f"Zotero Library ID: {zot_library_id}\n" +
-                  f"Zotero API Key: {zot_api_key}" +
-                  Style.RESET_ALL)
-            sys.exit(1)
+        """
+
+        if self.client is None:
+            from pyzotero import zotero
+
+            self.client = zotero.Zotero(self.library_id, self.library_type, self.api_key)
+
+        return self.client
+
+    def load_collections(self, collections):
+        """
+
+        Build the collection tree in memory and
+        compute the full path of every collection
+
+        Args:
+            collections: list of zotero collections
+
+        """
+
+        self.collections = {c['key']: c for c in collections}
+        self.paths = {}
+
+        for key in self.collections:
+            self.path_to(key)
 
     def path_to(self, collectionId):
         """
 
-        Recursively gets the full path to the collection
+        Gets the full path to the collection from the
+        in-memory collection tree, memoized in self.paths
 
         Args:
             collectionId: zotero collection ID
@@ -47,12 +138,65 @@ class Zotero():
 
         """
 
-        if collectionId:
-            c = self.zot.collection(collectionId)
-            return f"{self.path_to(c['data']['parentCollection'])}{c['data']['name']}/"
-        else:
+        if not collectionId:
             return ""
 
+        if collectionId not in self.paths:
+            if collectionId in self.collections:
+                c = self.collections[collectionId]
+            else:
+                c = self.zot.collection(collectionId)
+
+            self.paths[collectionId] = f"{self.path_to(c['data']['parentCollection'])}{c['data']['name']}/"
+
+        return self.paths[collectionId]
+
+    def pages(self, page):
+        """
+
+        Iterate over a paginated listing,
+        yielding every page as it arrives
+
+        Args:
+            page: first page of the listing
+
+        """
+
+        while True:
+            yield page
+
+            if not self.zot.links or not self.zot.links.get('next'):
+                return
+
+            page = self.zot.follow()
+
+    def add_attachment(self, item, collections):
+        """
+
+        Add a .pdf attachment to self.files once
+        for every collection it belongs to
+
+        Args:
+            item: zotero attachment item
+            collections: keys of the collections of the item
+
+        """
+
+        file_name = item['data'].get('title', '')
+
+        if '.pdf' not in file_name:
+            return
+
+        parent = item['data'].get('parentItem')
+
+        for key in collections:
+            if key in self.collections:
+                file_path = os.path.join(self.path_to(key), file_name)
+                self.files.append(File(file_path, item['key'], parent,
+                                       item.get('version'),
+                                       item['data'].get('md5'),
+                                       item['data'].get('mtime')))
+
     def fetch(self):
         """
 
@@ -63,39 +207,585 @@ class Zotero():
         """
 
         self.files = []
+        self.excluded = {}
+
+        try:
+            if self.fetch_mode == 'collections':
+                # One flat, paginated listing of every collection.
+                # all_collections() would query the children of each one.
+                self.load_collections(
+                    self.zot.everything(self.zot.collections(limit=PAGE_SIZE)))
+
+                success = self.fetch_collections()
+
+            else:
+                success = self.fetch_library()
+
+        except UserNotAuthorised:
+            print(Fore.RED +
+                  "ERROR - Zotero API error... " +
+                  "Please run ensure the details are correct\n" +
+                  f"Zotero Library ID: {self.library_id}\n" +
+                  f"Zotero API Key: {self.api_key}" +
+                  Style.RESET_ALL)
+            return False
+
+        self.by_path = {i.path: i for i in self.files}
+
+        return success
+
+    def changed(self):
+        """
+
+        Check with a single request if the library
+        version changed since it was last seen
+
+        Returns: True if it changed, or was never seen
+
+        """
+
+        version = self.zot.last_modified_version()
+        changed = version != self.seen
+
+        self.seen = version
+        self.probed = version
+
+        return changed
+
+    def fetch_collections(self):
+        """
+
+        Fetch the .pdf attachments listing the items
+        of every collection in scope. The parents are
+        requested only if there are tag or type rules.
+
+        Returns: True is success, False otherwise
+
+        """
+
+        listed = []
+
+        for c in self.collections.values():
+            if c['meta']['numItems'] > 0 and self.scope.collection(self.path_to(c['key'])):
+                items = self.zot.collection_items(c['key'], limit=PAGE_SIZE)
 
-        for c in self.zot.all_collections():
-            if c['meta']['numItems'] > 0:
-                collection_name = c['data']['name']
-                parent_path = self.path_to(c['data']['parentCollection'])
-                path = os.path.join(parent_path, collection_name)
+                for page in self.pages(items):
+                    for item in page:
+                        if item['data']['itemType'] == 'attachment':
+                            listed.append((item, c['key']))
 
-                for item in self.zot.collection_items(c['key']):
-                    if item['data']['itemType'] == 'attachment':
-                        file_name = item['data']['title']
+        if self.scope.items:
+            self.attachments = {}
+            self.parents = {}
 
-                        if '.pdf' in file_name:
-                            file_path = os.path.join(path, file_name)
+            for item, _ in listed:
+                self.store_attachment(item)
 
-                            parent = None
-                            if 'parentItem' in item['data'].keys():
-                                parent = item['data']['parentItem']
+            self.fetch_parents()
 
-                            file = File(file_path, item['key'], parent)
-                            self.files.append(file)
+        for item, key in listed:
+            parent = item['data'].get('parentItem')
+
+            if not self.scope.items:
+                in_scope = True
+            elif parent:
+                in_scope = self.parents.get(parent) is not None and \
+                    self.scope.item(self.parents[parent]['tags'], self.parents[parent]['itemType'])
+            else:
+                in_scope = self.scope.item([t['tag'] for t in item['data'].get('tags', [])],
+                                           'attachment')
+
+            if in_scope:
+                self.add_attachment(item, [key])
+            else:
+                self.excluded.setdefault(item['key'], [])
+
+        return True
+
+    def fetch_library(self):
+        """
+
+        Fetch the .pdf attachments of the whole library.
+
+        The library version is probed first. If it matches
+        the version of the last sync, the saved state is
+        reused without listing anything. If there is a saved
+        state, only the changes since its version are listed.
+        Otherwise all the attachments are listed at once.
+
+        Returns: True is success, False otherwise
+
+        """
+
+        if self.probed is not None:
+            version = self.probed
+        else:
+            version = self.zot.last_modified_version()
+
+        self.probed = None
+
+        # The state of the previous fetch is kept in memory
+        # while watching, it is only loaded the first time
+        if self.version is not None:
+            if self.version != version:
+                self.fetch_since(self.version)
+
+        else:
+            state = self.load_state()
+
+            # The state only has the parents in scope,
+            # it is listed again if the rules changed
+            if state is None or state.get('scope') != self.scope.state():
+                self.fetch_all()
+
+            else:
+                self.load_collections(state['collections'].values())
+                self.attachments = state['attachments']
+                self.parents = state['parents']
+                self.saved = state['version']
+
+                if state['version'] != version:
+                    self.fetch_since(state['version'])
+
+        self.version = version
+        self.seen = version
+        self.build_files()
 
         return True
 
+    def fetch_all(self):
+        """
+
+        List all the collections and all the .pdf
+        attachments with single paginated listings
+
+        """
+
+        self.load_collections(
+            self.zot.everything(self.zot.collections(limit=PAGE_SIZE)))
 
-    def pull(self, to_add, to_delete, verbose = False):
+        self.attachments = {}
+        self.parents = {}
+
+        # The API has no content type filter, the quick
+        # search narrows the listing to .pdf titles
+        items = self.zot.items(itemType='attachment', q='.pdf',
+                               limit=PAGE_SIZE)
+
+        for page in self.pages(items):
+            for item in page:
+                self.store_attachment(item)
+
+        self.fetch_parents()
+
+    def fetch_since(self, version):
         """
 
-        Pull from Zotero the files to add and
-        the files to remove from the local copy
+        Apply to the saved state the collections,
+        items and deletions since a library version
 
         Args:
-            to_add: list of files to add
+            version: library version of the saved state
+
+        """
+
+        collections = self.zot.everything(
+            self.zot.collections(since=version, limit=PAGE_SIZE))
+
+        if collections:
+            self.load_collections(list(self.collections.values()) + collections)
+
+        # Trashed items are not listed unless
+        # requested, they are removed like deletions
+        items = self.zot.items(since=version, includeTrashed=1,
+                               limit=PAGE_SIZE)
+
+        for page in self.pages(items):
+            for item in page:
+                if item['data']['itemType'] == 'attachment':
+                    self.store_attachment(item)
+
+                elif item['key'] in self.parents:
+                    self.store_parent(item)
+
+        deleted = self.zot.deleted(since=version)
+
+        for key in deleted.get('items', []):
+            self.attachments.pop(key, None)
+            self.parents.pop(key, None)
+
+        if deleted.get('collections', []):
+            self.load_collections([c for c in self.collections.values()
+                                   if c['key'] not in deleted['collections']])
+
+        self.fetch_parents()
+
+    def store_attachment(self, item):
+        """
+
+        Keep the fields needed to sync a .pdf attachment.
+        Trashed or non .pdf attachments are removed.
+
+        Args:
+            item: zotero attachment item
+
+        """
+
+        data = item['data']
+
+        if data.get('deleted') or '.pdf' not in data.get('title', ''):
+            self.attachments.pop(item['key'], None)
+            return
+
+        self.attachments[item['key']] = {
+            'title': data['title'],
+            'version': item.get('version'),
+            'md5': data.get('md5'),
+            'mtime': data.get('mtime'),
+            'parentItem': data.get('parentItem'),
+            'collections': data.get('collections', []),
+            'tags': [t['tag'] for t in data.get('tags', [])],
+            'date': data.get('dateModified') or data.get('dateAdded'),
+        }
+
+    def store_parent(self, item):
+        """
+
+        Keep the collections, the tags and the type
+        of the parent item of one or more attachments
+
+        Args:
+            item: zotero parent item
+
+        """
+
+        data = item['data']
+
+        self.parents[item['key']] = {
+            'collections': [] if data.get('deleted') else data.get('collections', []),
+            'tags': [t['tag'] for t in data.get('tags', [])],
+            'itemType': data.get('itemType'),
+        }
+
+    def fetch_parents(self):
+        """
+
+        Request in batches the parent items that are
+        not in self.parents yet. The tag and item type
+        rules are applied by the API, the parents it
+        does not return are kept as None, out of scope.
+
+        """
+
+        keys = list({a['parentItem'] for a in self.attachments.values()
+                     if a['parentItem'] and a['parentItem'] not in self.parents})
+
+        for i in range(0, len(keys), KEYS_PER_REQUEST):
+            batch = keys[i:i + KEYS_PER_REQUEST]
+
+            for page in self.pages(self.zot.items(itemKey=','.join(batch),
+                                                  limit=KEYS_PER_REQUEST,
+                                                  **self.scope.params())):
+                for parent in page:
+                    self.store_parent(parent)
+
+            for key in batch:
+                self.parents.setdefault(key, None)
+
+    def build_files(self):
+        """
+
+        Build self.files from the attachments in scope.
+        Child attachments take the collections, the tags
+        and the type of their parents.
+
+        """
+
+        self.files = []
+
+        for key, a in self.attachments.items():
+            if a['parentItem']:
+                parent = self.parents.get(a['parentItem'])
+
+                if parent is None:
+                    self.excluded[key] = []
+                    continue
+
+                collections = parent['collections']
+                in_scope = self.scope.item(parent['tags'], parent['itemType'])
+
+            else:
+                collections = a['collections']
+                in_scope = self.scope.item(a.get('tags', []), 'attachment')
+
+            for c in collections:
+                if c in self.collections:
+                    file_path = os.path.join(self.path_to(c), a['title'])
+
+                    if in_scope and self.scope.collection(self.path_to(c)):
+                        self.files.append(File(file_path, key, a['parentItem'],
+                                               a.get('version'), a.get('md5'),
+                                               a.get('mtime'), timestamp(a.get('date'))))
+                    else:
+                        self.excluded.setdefault(key, []).append(file_path)
+
+    def load_state(self):
+        """
+
+        Load the state saved after the last sync
+
+        Returns: dict with the state, None if there is no state
+
+        """
+
+        return load_json(self.state_file)
+
+    def save_state(self):
+        """
+
+        Save the library version and the fetched
+        attachments after a successful sync, unless
+        the saved state has the same version
+
+        Returns: True is success, False otherwise
+
+        """
+
+        if self.version is None or self.version == self.saved:
+            return True
+
+        self.saved = self.version
+
+        return save_json(self.state_file, {
+            'version': self.version,
+            'collections': {k: {'key': k,
+                                'data': {'name': c['data']['name'],
+                                         'parentCollection': c['data']['parentCollection']}}
+                            for k, c in self.collections.items()},
+            'attachments': self.attachments,
+            'parents': self.parents,
+            'scope': self.scope.state(),
+        })
+
+    def download(self, item_id, file_path):
+        """
+
+        Stream the file of an attachment to a temporary
+        file and move it into place once complete
+
+        Args:
+            item_id: zotero attachment key
+            file_path: local path of the file
+
+        Returns: (md5, size) of the downloaded file
+
+        """
+
+        url = f"{self.zot.endpoint}/{self.zot.library_type}/" + \
+              f"{self.zot.library_id}/items/{item_id}/file"
+
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.pdf')
+        md5 = hashlib.md5()
+        size = 0
+
+        try:
+            with os.fdopen(fd, 'wb') as f, \
+                 requests.get(url, headers=self.zot.default_headers(),
+                              stream=True, timeout=TIMEOUT) as r:
+                r.raise_for_status()
+
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    md5.update(chunk)
+                    size += len(chunk)
+
+            os.replace(tmp_path, file_path)
+
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return md5.hexdigest(), size
+
+    def download_file(self, file, file_path):
+        """
+
+        Download a fetched file to any local path,
+        recording its md5 and size in self.downloaded
+
+        Args:
+            file: path of the file in the library
+            file_path: local path to download to
+
+        """
+
+        start = time.perf_counter()
+        self.downloaded[file] = self.download(self.by_path[file].id, file_path)
+
+        report.transfer('zotero', 'download', file,
+                        time.perf_counter() - start, self.downloaded[file][1])
+
+    def blob(self, md5):
+        """
+
+        Args:
+            md5: md5 of the content of a file
+
+        Returns: path of the file in the store
+
+        """
+
+        return os.path.join(self.store_dir, md5[:2], f"{md5}.pdf")
+
+    def fetch_blob(self, file):
+        """
+
+        Download the file of an attachment to the store,
+        unless a file with the md5 reported by Zotero
+        is already stored
+
+        Args:
+            file: fetched File
+
+        Returns: (md5, size) of the file
+
+        """
+
+        if file.md5 and os.path.exists(self.blob(file.md5)):
+            return file.md5, os.path.getsize(self.blob(file.md5))
+
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.pdf')
+        os.close(fd)
+
+        start = time.perf_counter()
+
+        try:
+            md5, size = self.download(file.id, tmp_path)
+
+            os.makedirs(os.path.dirname(self.blob(md5)), exist_ok=True)
+            os.replace(tmp_path, self.blob(md5))
+
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        report.transfer('zotero', 'download', file.path,
+                        time.perf_counter() - start, size)
+
+        return md5, size
+
+    def materialize(self, md5, file_path):
+        """
+
+        Hardlink a stored file to a local path, replacing
+        the file there. It is copied if the file system
+        does not support hardlinks.
+
+        Args:
+            md5: md5 of the stored file
+            file_path: local path of the file
+
+        """
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.pdf')
+        os.close(fd)
+        os.remove(tmp_path)
+
+        try:
+            try:
+                os.link(self.blob(md5), tmp_path)
+                self.hardlinks = True
+
+            except OSError:
+                shutil.copyfile(self.blob(md5), tmp_path)
+                self.hardlinks = False
+
+            os.replace(tmp_path, file_path)
+
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def linkable(self):
+        """
+
+        Check once if the stored files can be hardlinked
+        to the local directory, they are copied otherwise
+
+        Returns: True if they can
+
+        """
+
+        if self.hardlinks is None:
+            os.makedirs(self.store_dir, exist_ok=True)
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            fd, probe = tempfile.mkstemp(dir=self.store_dir)
+            os.close(fd)
+            link = os.path.join(self.tmp_dir, os.path.basename(probe))
+
+            try:
+                os.link(probe, link)
+                os.remove(link)
+                self.hardlinks = True
+
+            except OSError:
+                self.hardlinks = False
+
+            finally:
+                os.remove(probe)
+
+        return self.hardlinks
+
+    def collect(self, md5s):
+        """
+
+        Remove from the store the given files that are
+        no longer linked to any local path. Copied files
+        are never linked, nothing is removed then.
+
+        Args:
+            md5s: md5 of the stored files to check
+
+        """
+
+        if not md5s or not self.linkable():
+            return
+
+        for md5 in set(md5s):
+            try:
+                if os.stat(self.blob(md5)).st_nlink <= 1:
+                    os.remove(self.blob(md5))
+
+            except FileNotFoundError:
+                pass
+
+    def pull(self, transfers, to_delete, to_move = (),
+             commit = None, budget = None, verbose = False):
+        """
+
+        Pull from Zotero the files to add, the files to
+        move, the modified files and the files to remove
+        from the local copy
+
+        Args:
+            transfers: list of (op, path) of the files to add
+                       ('add') and of the modified files to
+                       download again ('update')
             to_delete: list of files to delete
+            to_move: list of (old, new) files to move
+            commit: function called with the op and the path
+                    of every completed operation
+            budget: Budget of the run, the files are downloaded
+                    in the order of transfers until it is
+                    exhausted
             verbose: enable print information
 
         Returns: True is success, False otherwise
@@ -105,31 +795,106 @@ class Zotero():
         if verbose:
             print("Zotero - Pull information")
 
-        files_to_add = [i for i in self.files if i.path in to_add]
-        for file in files_to_add:
-            file_path = os.path.join(self.dir, file.path)
+        commit = commit or (lambda op, path: None)
+        budget = budget or Budget()
+        moved = set()
+
+        for old, new in to_move:
+            old_path = os.path.join(self.dir, old)
+            new_path = os.path.join(self.dir, new)
 
             try:
-                if not os.path.exists(os.path.dirname(file_path)):
-                    os.makedirs(os.path.dirname(file_path))
+                # The local copy is gone, it is downloaded again
+                if not os.path.exists(old_path) and not os.path.exists(new_path):
+                    moved.add(new)
+                    continue
+
+                # Already moved by an interrupted sync
+                if os.path.exists(old_path):
+                    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                    os.replace(old_path, new_path)
 
-                with open(file_path, 'wb') as f:
-                    f.write(self.zot.file(file.id))
+                commit('move', new)
 
                 if verbose:
                     print(Fore.GREEN +
-                          f"\t New: {file_path}" +
+                          f"\t Moved: {old_path} -> {new_path}" +
                           Style.RESET_ALL)
 
             except Exception as ex:
                 print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
                 return False
 
+        files_to_add = [self.by_path[i] for i in dict.fromkeys(list(moved) +
+                                                               [path for op, path in transfers])
+                        if i in self.by_path]
+        to_update = {path for op, path in transfers if op == 'update'}
+        errors = []
+
+        # An attachment in several collections, or the same
+        # content in several attachments, is downloaded once
+        # and linked to each of its paths
+        groups = {}
+        for file in files_to_add:
+            groups.setdefault(file.md5 or file.id, []).append(file)
+
+        def fetch(file):
+            # Left for the next run
+            if budget.exhausted:
+                return None
+
+            stored = file.md5 and os.path.exists(self.blob(file.md5))
+            md5, size = self.fetch_blob(file)
+
+            if not stored:
+                budget.spend(size)
+
+            return md5, size
+
+        # The pool starts the downloads in the given order
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(fetch, files[0]): files
+                       for files in groups.values()}
+
+            for future in as_completed(futures):
+                for file in futures[future]:
+                    file_path = os.path.join(self.dir, file.path)
+
+                    try:
+                        if future.result() is None:
+                            continue
+
+                        md5, size = future.result()
+                        self.materialize(md5, file_path)
+                        self.downloaded[file.path] = (md5, size)
+                        commit('move' if file.path in moved else
+                               'update' if file.path in to_update else 'add', file.path)
+
+                        if verbose:
+                            print(Fore.GREEN +
+                                  f"\t New: {file_path}" +
+                                  Style.RESET_ALL)
+
+                    except Exception as ex:
+                        errors.append((file_path, ex))
+
+        for file_path, ex in errors:
+            print(Fore.RED + f"ERROR - {file_path}: {ex}" + Style.RESET_ALL)
+
+        if errors:
+            print(Fore.RED +
+                  f"ERROR - {len(errors)} of {len(files_to_add)} downloads failed" +
+                  Style.RESET_ALL)
+            return False
+
         for file in to_delete:
             file_path = os.path.join(self.dir, file)
 
             try:
-                os.remove(file_path)
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+                commit('delete', file)
 
                 if verbose:
                     print(Fore.RED +
@@ -144,7 +909,7 @@ class Zotero():
 
 
 
-    def push(self, to_add, to_delete, verbose = False):
+    def push(self, to_add, to_delete, commit = None, verbose = False):
         """
 
         Push to Zotero the files to add
@@ -155,6 +920,8 @@ class Zotero():
         Args:
             to_add: list of files to add
             to_delete: list of files to delete
+            commit: function called with the op and the path
+                    of every completed operation
             verbose: enable print information
 
         Returns: True is success, False otherwise
@@ -164,6 +931,8 @@ class Zotero():
         if verbose:
             print("Zotero - Push information")
 
+        commit = commit or (lambda op, path: None)
+
         # TODO: Push new files to Zotero
         # for file in to_add:
         #     # Push file
@@ -172,24 +941,52 @@ class Zotero():
         #               "\t New: " +
         #               file.path + Style.RESET_ALL)
 
+        to_delete = set(to_delete)
         files_to_delete = [i for i in self.files if i.path in to_delete]
-        for file in files_to_delete:
-            if file.parent:
-                id = file.parent
-            else:
-                id = file.id
 
-            try:
-                item = self.zot.item(id)
-                self.zot.delete_item(item)
+        # Delete the parent item, or the attachment if it has
+        # none, once even if several of its files are deleted
+        keys = list(dict.fromkeys(i.parent or i.id for i in files_to_delete))
 
-                if verbose:
-                    print(Fore.RED +
-                          "\t Deleted: {file.path}" +
-                          Style.RESET_ALL)
+        if len(keys) == 0:
+            return True
 
-            except Exception as ex:
-                print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
-                return False
+        try:
+            # Library version of the last fetch, the API rejects
+            # the request if the library was modified since
+            version = self.version
+            if version is None:
+                version = self.zot.last_modified_version()
+
+            for i in range(0, len(keys), KEYS_PER_REQUEST):
+                batch = keys[i:i + KEYS_PER_REQUEST]
+                self.zot.delete_item([{'key': k} for k in batch], last_modified=version)
+
+                deleted = {i.path for i in files_to_delete if (i.parent or i.id) in batch}
+
+                for path in deleted:
+                    commit('delete', path)
+
+                # Not recorded again with the files of this run
+                self.files = [i for i in self.files if i.path not in deleted]
+                for path in deleted:
+                    self.by_path.pop(path, None)
+
+                # Every delete creates a new library version. The
+                # fetched version is kept in the state so the next
+                # incremental fetch reports the deletions, the
+                # version seen by changed() is the new one.
+                version = int(self.zot.request.headers.get('last-modified-version', version))
+                self.seen = version
+
+        except Exception as ex:
+            print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+            return False
+
+        if verbose:
+            for file in files_to_delete:
+                print(Fore.RED +
+                      f"\t Deleted: {file.path}" +
+                      Style.RESET_ALL)
 
         return True
@@ -0,0 +1,326 @@
+import os
+import sys
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+from colorama import Fore, Style
+from utils.common import File, timestamp
+from utils.zotero import Zotero, CHUNK_SIZE
+
+class ZoteroLocal(Zotero):
+
+    def __init__(self, dir, zot_data_dir, workers = 4, scope = None):
+        """
+
+        Initialize the local zotero instance, reading the
+        zotero.sqlite database and the storage directory
+        of Zotero desktop instead of the web API
+
+        Args:
+            dir: local directory
+            zot_data_dir: Zotero data directory
+            workers: number of concurrent copies
+            scope: Scope of the files to sync, all of them if None
+
+        """
+
+        super().__init__(dir, None, None, workers = workers, scope = scope)
+
+        self.data_dir = os.path.expanduser(zot_data_dir)
+
+        # Path of the file of every attachment
+        self.sources = {}
+
+        if not os.path.exists(os.path.join(self.data_dir, 'zotero.sqlite')):
+            print(Fore.RED +
+                  "ERROR - Zotero database not found... " +
+                  "Please ensure the data directory is correct\n" +
+                  f"Zotero Data Directory: {self.data_dir}" +
+                  Style.RESET_ALL)
+            sys.exit(1)
+
+    def connect(self):
+        """
+
+        Copy the database, locked while Zotero is
+        running, and open the copy
+
+        Returns: (sqlite3 connection, directory of the copy)
+
+        """
+
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        copy_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        copy = os.path.join(copy_dir, 'zotero.sqlite')
+
+        for suffix in ('', '-wal'):
+            source = os.path.join(self.data_dir, f'zotero.sqlite{suffix}')
+            if os.path.exists(source):
+                shutil.copyfile(source, f'{copy}{suffix}')
+
+        db = sqlite3.connect(copy)
+        db.row_factory = sqlite3.Row
+
+        return db, copy_dir
+
+    def changed(self):
+        """
+
+        Check if the database was written since it was
+        last seen, from the modification time of its files
+
+        Returns: True if it changed, or was never seen
+
+        """
+
+        stamp = tuple(os.stat(f).st_mtime_ns if os.path.exists(f) else None
+                      for f in (os.path.join(self.data_dir, f'zotero.sqlite{suffix}')
+                                for suffix in ('', '-wal')))
+
+        changed = stamp != self.seen
+        self.seen = stamp
+
+        return changed
+
+    def fetch(self):
+        """
+
+        Fetch all the .pdf file stored in the
+        user library of the Zotero database.
+
+        Returns: True is success, False otherwise
+
+        """
+
+        self.files = []
+        self.sources = {}
+        self.excluded = {}
+
+        try:
+            db, copy_dir = self.connect()
+
+        except Exception as ex:
+            print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+            return False
+
+        try:
+            self.fetch_db(db)
+
+        except Exception as ex:
+            print(Fore.RED + f"ERROR - {ex}" + Style.RESET_ALL)
+            return False
+
+        finally:
+            db.close()
+            shutil.rmtree(copy_dir, ignore_errors=True)
+
+        self.by_path = {i.path: i for i in self.files}
+
+        return True
+
+    def fetch_db(self, db):
+        """
+
+        Read the collections and the .pdf attachments
+        of the user library from the database
+
+        Args:
+            db: sqlite3 connection to the database
+
+        """
+
+        library = db.execute("SELECT libraryID FROM libraries " +
+                             "WHERE type = 'user'").fetchone()[0]
+
+        tables = {r['name'] for r in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+        deleted_collections = set()
+        if 'deletedCollections' in tables:
+            deleted_collections = {r[0] for r in db.execute(
+                "SELECT collectionID FROM deletedCollections")}
+
+        rows = [r for r in db.execute("""SELECT collectionID, collectionName,
+                                                parentCollectionID, key
+                                         FROM collections
+                                         WHERE libraryID = ?""", (library,))
+                if r['collectionID'] not in deleted_collections]
+
+        keys = {r['collectionID']: r['key'] for r in rows}
+
+        self.load_collections([{'key': r['key'],
+                                'data': {'name': r['collectionName'],
+                                         'parentCollection': keys.get(r['parentCollectionID'], False)}}
+                               for r in rows])
+
+        memberships = {}
+        for r in db.execute("SELECT collectionID, itemID FROM collectionItems"):
+            if r['collectionID'] in keys:
+                memberships.setdefault(r['itemID'], []).append(keys[r['collectionID']])
+
+        attachments = db.execute("""
+            SELECT i.itemID, i.key, i.version, i.dateAdded, i.dateModified,
+                   a.parentItemID, p.key AS parentKey, a.path, a.linkMode,
+                   a.storageHash, a.storageModTime, v.value AS title
+            FROM itemAttachments a
+            JOIN items i ON i.itemID = a.itemID
+            LEFT JOIN items p ON p.itemID = a.parentItemID
+            LEFT JOIN itemData d ON d.itemID = i.itemID AND d.fieldID =
+                (SELECT fieldID FROM fields WHERE fieldName = 'title')
+            LEFT JOIN itemDataValues v ON v.valueID = d.valueID
+            WHERE i.libraryID = ?
+              AND i.itemID NOT IN (SELECT itemID FROM deletedItems)
+              AND (a.parentItemID IS NULL OR
+                   a.parentItemID NOT IN (SELECT itemID FROM deletedItems))
+            """, (library,))
+
+        tags = {}
+        types = {}
+        missing = []
+
+        if self.scope.items:
+            for r in db.execute("""SELECT it.itemID, t.name FROM itemTags it
+                                   JOIN tags t ON t.tagID = it.tagID"""):
+                tags.setdefault(r['itemID'], []).append(r['name'])
+
+            types = {r['itemID']: r['typeName'] for r in db.execute(
+                """SELECT i.itemID, t.typeName FROM items i
+                   JOIN itemTypes t ON t.itemTypeID = i.itemTypeID
+                   WHERE i.libraryID = ?""", (library,))}
+
+        for a in attachments:
+            title = a['title'] or ''
+            source = self.storage_path(a['key'], a['path'])
+
+            if '.pdf' not in title or source is None:
+                continue
+
+            self.sources[a['key']] = source
+            date = timestamp(a['dateModified'] or a['dateAdded'])
+
+            # Files not downloaded by Zotero desktop yet are
+            # left out of scope, their copies are kept
+            try:
+                size = os.path.getsize(source)
+
+            except OSError:
+                size = None
+                missing.append(title)
+
+            item = a['parentItemID'] or a['itemID']
+            in_scope = self.scope.item(tags.get(item, []),
+                                       types.get(item) if a['parentItemID'] else 'attachment')
+
+            for c in memberships.get(item, []):
+                file_path = os.path.join(self.path_to(c), title)
+
+                if in_scope and size is not None and self.scope.collection(self.path_to(c)):
+                    self.files.append(File(file_path, a['key'], a['parentKey'],
+                                           a['version'], a['storageHash'],
+                                           a['storageModTime'], date, size))
+                else:
+                    self.excluded.setdefault(a['key'], []).append(file_path)
+
+        if missing:
+            print(Fore.YELLOW +
+                  f"{len(missing)} attachments have no file in {self.data_dir}, " +
+                  "skipped until Zotero desktop downloads them." +
+                  Style.RESET_ALL)
+
+    def storage_path(self, key, path):
+        """
+
+        Path of the file of an attachment
+
+        Args:
+            key: zotero attachment key
+            path: path of the attachment in the database
+
+        Returns: path of the file, None if the attachment has no file
+
+        """
+
+        if not path:
+            return None
+
+        if path.startswith('storage:'):
+            return os.path.join(self.data_dir, 'storage', key, path[len('storage:'):])
+
+        if os.path.isabs(path):
+            return path
+
+        return None
+
+    def download(self, item_id, file_path):
+        """
+
+        Copy the file of an attachment to a temporary
+        file and move it into place once complete
+
+        Args:
+            item_id: zotero attachment key
+            file_path: local path of the file
+
+        Returns: (md5, size) of the copied file
+
+        """
+
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.pdf')
+        md5 = hashlib.md5()
+        size = 0
+
+        try:
+            with os.fdopen(fd, 'wb') as f, open(self.sources[item_id], 'rb') as r:
+                for chunk in iter(lambda: r.read(CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    md5.update(chunk)
+                    size += len(chunk)
+
+            os.replace(tmp_path, file_path)
+
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return md5.hexdigest(), size
+
+    def push(self, to_add, to_delete, commit = None, verbose = False):
+        """
+
+        The Zotero database is only written by Zotero
+        desktop, files deleted in reMarkable are reported
+        and have to be deleted in Zotero
+
+        Args:
+            to_add: list of files to add
+            to_delete: list of files to delete
+            commit: not called, no file is deleted
+            verbose: enable print information
+
+        Returns: True
+
+        """
+
+        for file in to_delete:
+            print(Fore.YELLOW +
+                  f"\t Delete in Zotero desktop: {file}" +
+                  Style.RESET_ALL)
+
+        return True
+
+    def save_state(self):
+        """
+
+        The local database is read in full every
+        run, there is no state to save
+
+        Returns: True
+
+        """
+
+        return True